@@ -0,0 +1,75 @@
+#!/bin/env python3
+"""Separate frames vs one batch frame.
+
+Runs the requests a reconnecting client sends (enter_room and a few check requests) through
+Chat.handle_incoming_frame, once as separate encrypted frames and once as one encrypted
+batch frame, and reports requests per second for both.
+
+usage: python3 benchmarks/batch_requests.py [rounds]
+"""
+
+import os
+import sys
+import json
+import tempfile
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import websocketchat
+from websocketchat import crypto
+from websocketchat.async_server import Frame
+from ewebsockets import OpCode
+
+
+class NullWebsocket:
+    address = ('127.0.0.1', 1)
+
+    def send_text(self, text, timeout=-1):
+        return len(text)
+
+
+requests = [
+    ['6', 1, 'example.com/lobby', 0],
+    ['7', 2, 'Someone42'],
+    ['8', 3, 'someone@example.com'],
+    ['7', 4, 'Someone43'],
+    ['8', 5, 'someone.else@example.com'],
+]
+
+
+def encrypted_frame(client, request_id, array):
+    text = request_id + json.JSONEncoder().encode(array)
+    return Frame(OpCode.TEXT, b'1' + crypto.encrypt(text.encode(), client.key, client.iv).hex().encode())
+
+
+def run(chat, websocket, frames, rounds):
+    t0 = perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            chat.handle_incoming_frame(websocket, frame)
+    return perf_counter() - t0
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    chat = websocketchat.Chat(db_threads=0, db_kwargs={'name': path})
+    websocket = NullWebsocket()
+    chat.on_client_open(websocket)
+    client = chat.clients[websocket.address]
+
+    separate = [encrypted_frame(client, request[0], request[1:]) for request in requests]
+    batch = [encrypted_frame(client, 'f', [0] + requests)]
+
+    n = rounds * len(requests)
+    separate_time = run(chat, websocket, separate, rounds)
+    batch_time = run(chat, websocket, batch, rounds)
+    print('{} requests in frames of 1 and of {}'.format(n, len(requests)))
+    print('  separate: {:>10.0f} requests/s'.format(n / separate_time))
+    print('  batched:  {:>10.0f} requests/s'.format(n / batch_time))
+    chat.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/bin/env python3
+"""Compares the cost of fanning a chat line out to a room, encoding per recipient
+(the old ChatRoom.broadcast) against encoding once per broadcast.
+
+usage: python3 benchmarks/broadcast_fanout.py [members]
+"""
+
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat.chat_room import ChatRoom
+from websocketchat.client import Client
+from websocketchat.crypto import generate_key_and_iv
+from websocketchat.forms import server_message_ids
+
+
+class NullWebsocket:
+    def __init__(self, i):
+        self.address = ('127.0.0.1', i)
+        self.sent = 0
+
+    def send_text(self, text, timeout=-1):
+        self.sent += len(text)
+        return len(text)
+
+
+def make_room(members):
+    room = ChatRoom('example.com', 1)
+    for i in range(members):
+        client = Client(websocket=NullWebsocket(i), send_executor=None)
+        client.key, client.iv = generate_key_and_iv()
+        client.name = 'User{}'.format(i)
+        room.clients[client] = None
+    return room
+
+
+def per_recipient(room, type_id, message_array, encrypt):
+    for client in room.clients:
+        client.send(type_id, message_array, encrypt)
+
+
+def serialize_once(room, type_id, message_array, encrypt):
+    room.broadcast(type_id, message_array, encrypt)
+
+
+def measure(function, room, encrypt, repeat=5):
+    message_array = [123456, 1500000000.123, 'User0', 'Hello there! ' * 8]
+    type_id = server_message_ids['single_message']['id']
+    best = None
+    for _ in range(repeat):
+        t0 = perf_counter()
+        function(room, type_id, message_array, encrypt)
+        elapsed = perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    room = make_room(members)
+    print('{} members, best of 5 broadcasts'.format(members))
+    print('{:>10} {:>16} {:>16} {:>8}'.format('mode', 'per recipient', 'serialize once', 'speedup'))
+    for encrypt in (False, True):
+        before = measure(per_recipient, room, encrypt)
+        after = measure(serialize_once, room, encrypt)
+        print('{:>10} {:>13.2f} ms {:>13.2f} ms {:>7.1f}x'.format(
+            'encrypted' if encrypt else 'plaintext', before * 1000, after * 1000, before / after))
+
+
+if __name__ == '__main__':
+    main()
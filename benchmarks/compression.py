@@ -0,0 +1,56 @@
+#!/bin/env python3
+"""permessage-deflate on chat payloads.
+
+Reports the compressed size of an enter_room response with a full history and of a single
+room message, and the time to compress a broadcast for a room of N members: once per member
+(context takeover, a compressor per connection) and once for the room (no context takeover,
+AsyncWebsocket.compress_shared).
+
+usage: python3 benchmarks/compression.py [members] [history]
+"""
+
+import os
+import sys
+import json
+from time import perf_counter, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat.async_server import AsyncWebsocket, PerMessageDeflate, deflate
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    history = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    now = time()
+    messages = [[i, now + i, 'User{}'.format(i % 40), 'Message number {} in this room'.format(i)]
+                for i in range(history)]
+    enter_room = '06' + json.JSONEncoder().encode([1, messages])
+    message = '0z' + json.JSONEncoder().encode(messages[-1])
+
+    print('{:<22} {:>10} {:>12}'.format('payload', 'bytes', 'compressed'))
+    for name, payload in (('enter_room ({})'.format(history), enter_room), ('single_message', message)):
+        print('{:<22} {:>10} {:>12}'.format(name, len(payload), len(deflate(payload.encode(), 6, 15))))
+
+    # A longer message so it is above the default threshold
+    broadcast = '0z' + json.JSONEncoder().encode([history, now, 'User1', 'A somewhat longer chat message ' * 10])
+    connections = [PerMessageDeflate(6, 15, True, True) for _ in range(members)]
+    t0 = perf_counter()
+    for connection in connections:
+        connection.compress(broadcast.encode())
+    per_member = perf_counter() - t0
+
+    server = AsyncWebsocket(None, None, None, None, compression=True)
+    t0 = perf_counter()
+    for _ in range(members):
+        server.compress_shared(broadcast, 15)
+    shared = perf_counter() - t0
+    server.executor.shutdown()
+
+    print('Broadcast of {} bytes to {} members'.format(len(broadcast), members))
+    print('  compressed per member: {:>8.2f} ms'.format(per_member * 1000))
+    print('  compressed once:       {:>8.2f} ms'.format(shared * 1000))
+
+
+if __name__ == '__main__':
+    main()
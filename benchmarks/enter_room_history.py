@@ -0,0 +1,57 @@
+#!/bin/env python3
+"""Measures the history query behind handle_request_enter_room as a room grows.
+
+usage: python3 benchmarks/enter_room_history.py [max_messages]
+"""
+
+import os
+import sys
+import tempfile
+from time import time, perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat.database import ChatDb
+
+
+def fill(db, room_name, start, count):
+    t = time()
+    rows = [('User', 'message {}'.format(i), room_name, 1, t) for i in range(start, start + count)]
+    db.db.executemany('''INSERT INTO messages(user, text, room_name, show, time) VALUES(?, ?, ?, ?, ?)''', rows)
+    # Some noise from another room so the index actually has to filter on room_name
+    db.db.executemany('''INSERT INTO messages(user, text, room_name, show, time) VALUES(?, ?, ?, ?, ?)''',
+                      [(r[0], r[1], 'other.room', r[3], r[4]) for r in rows])
+    db.db.commit()
+
+
+def measure(db, room_name, repeat=200):
+    best = None
+    for _ in range(repeat):
+        t0 = perf_counter()
+        db.get_messages(room_name, 0, latest=100)
+        elapsed = perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    max_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = ChatDb(path)
+    room_name = 'example.com'
+
+    size = 0
+    step = 1000
+    print('{:>12} {:>14}'.format('messages', 'best (ms)'))
+    while size < max_messages:
+        fill(db, room_name, size, step)
+        size += step
+        print('{:>12} {:>14.3f}'.format(size, measure(db, room_name) * 1000))
+        step *= 10
+
+    db.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
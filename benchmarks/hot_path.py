@@ -0,0 +1,191 @@
+#!/bin/env python3
+"""Microbenchmarks of the per frame hot path with stored baselines.
+
+Every step handle_incoming_frame does for a frame (UTF-8 decode, validate_hexstring, str2hex,
+crypto.decrypt, JSON decode, validate_request) and that Client.send does for a response
+(encode_array, crypto.encrypt, hex) is timed on its own and end to end (Chat.read_request,
+Client.send), for a small and a large payload, plaintext and encrypted.
+
+    python3 benchmarks/hot_path.py                  run, compare with the baseline if there is one
+    python3 benchmarks/hot_path.py --save           run and store the results as the baseline
+    python3 benchmarks/hot_path.py -k decrypt       only the benchmarks with decrypt in the name
+
+Every benchmark is timed --repeat times and compared by the median. The exit status is 1 when
+a median is slower than the baseline by more than --threshold (default 20%) plus twice the
+spread (interquartile range over the median) of the baseline or of the run, whichever is larger.
+A benchmark that looks slower is timed again up to --retries times before it counts, short
+benchmarks on a busy machine can have a bad run now and then. Baselines are only comparable on
+the machine they were saved on, the machine and Python version are stored with them and a
+different one is pointed out.
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+from time import perf_counter, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import websocketchat
+from websocketchat import crypto
+from websocketchat.chat_server import str2hex
+from websocketchat.async_server import Frame
+from websocketchat.client import Client
+from websocketchat.forms import validate_request, validate_hexstring, encode_array, EncodedJson
+from ewebsockets import OpCode
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'hot_path.json')
+
+
+class NullWebsocket:
+    address = ('127.0.0.1', 1)
+
+    def send_text(self, text, timeout=-1):
+        return len(text)
+
+
+def measure(function, min_time=0.05, repeat=15):
+    """Seconds per call as {'min', 'median', 'spread'} over repeat runs, each run at least min_time long"""
+    loops = 1
+    while True:
+        t0 = perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = perf_counter() - t0
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    times = [elapsed / loops]
+    for _ in range(repeat - 1):
+        t0 = perf_counter()
+        for _ in range(loops):
+            function()
+        times.append((perf_counter() - t0) / loops)
+    median = statistics.median(times)
+    q1, _, q3 = statistics.quantiles(times, n=4)
+    return {'min': min(times), 'median': median, 'spread': (q3 - q1) / median}
+
+
+def slowdown(result, base, threshold):
+    """How much slower the median is than the baseline, and if that's more than the noise allows"""
+    ratio = result['median'] / base['median']
+    allowed = 1 + threshold / 100 + 2 * max(result['spread'], base['spread'])
+    return ratio, ratio > allowed
+
+
+def payloads():
+    small = '1' + json.JSONEncoder().encode([1, 'Hello there, how is everyone doing today?'])
+    large = '1' + json.JSONEncoder().encode([1, 'A long chat message with some text in it. ' * 100])
+    t = time()
+    history = EncodedJson(json.JSONEncoder().encode(
+        [[i, t + i, 'User{}'.format(i % 40), 'Message number {} in this room'.format(i)] for i in range(100)]))
+    # (name, request text, response array)
+    return [('small', small, [1, 1, 0, 'Someone', '0123456789ABCDEF0123456789ABCDEF']),
+            ('large', large, [1, history])]
+
+
+def benchmarks():
+    """{name: function}"""
+    chat = websocketchat.Chat(db_threads=0, request_timeout=None, db_kwargs={'name': ':memory:'})
+    websocket = NullWebsocket()
+    chat.on_client_open(websocket)
+    client = chat.clients[websocket.address]
+    key, iv = client.key, client.iv
+    # Flushing on the calling thread so the queue can't fill up and the write is part of the time
+    sender = Client(NullWebsocket(), send_executor=None)
+    sender.key, sender.iv = key, iv
+
+    cases = {}
+    for size, request, response in payloads():
+        encrypted_hex = crypto.encrypt(request.encode(), key, iv).hex()
+        ciphertext = str2hex(encrypted_hex)
+        plain_payload = ('0' + request).encode()
+        encrypted_payload = ('1' + encrypted_hex).encode()
+        encoded_response = encode_array(response)
+
+        # The steps of handle_incoming_frame
+        cases['utf8_decode/' + size] = lambda p=encrypted_payload: p[1:].decode('utf-8')
+        cases['validate_hexstring/' + size] = lambda h=encrypted_hex: validate_hexstring(h)
+        cases['str2hex/' + size] = lambda h=encrypted_hex: str2hex(h)
+        cases['decrypt/' + size] = lambda c=ciphertext: crypto.decrypt(c, key, iv)
+        cases['json_decode/' + size] = lambda r=request: json.JSONDecoder().decode(r[1:])
+        cases['validate_request/' + size] = lambda r=request: validate_request(r)
+        # The steps of Client.send
+        cases['encode_array/' + size] = lambda a=response: encode_array(a)
+        cases['encrypt/' + size] = lambda e=encoded_response: crypto.encrypt(('3' + e).encode(), key, iv).hex()
+
+        for mode, payload in (('plain', plain_payload), ('encrypted', encrypted_payload)):
+            frame = Frame(OpCode.TEXT, payload)
+            cases['read_request/{}/{}'.format(size, mode)] = lambda f=frame: chat.read_request(client, f)
+        for mode, enc in (('plain', False), ('encrypted', True)):
+            cases['client_send/{}/{}'.format(size, mode)] = lambda a=response, e=enc: sender.send('3', a, e)
+    return chat, cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot path microbenchmarks')
+    parser.add_argument('-k', dest='keyword', help='only run benchmarks with this in their name')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=20, help='allowed slowdown in %% before failing')
+    parser.add_argument('--min-time', type=float, default=0.05, help='seconds per run')
+    parser.add_argument('--repeat', type=int, default=15, help='runs per benchmark')
+    parser.add_argument('--retries', type=int, default=2, help='times a slower benchmark is timed again')
+    args = parser.parse_args()
+
+    baseline = {}
+    machine = {'python': sys.version.split()[0], 'platform': platform.platform(), 'machine': platform.machine(),
+               'cpus': os.cpu_count()}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        differences = ['{} {} (baseline {})'.format(key, value, saved.get(key)) for key, value in machine.items()
+                       if saved.get(key) != value]
+        if differences:
+            print('The baseline was saved elsewhere, the comparison is rough: {}'.format(', '.join(differences)))
+
+    chat, cases = benchmarks()
+    results = {}
+    regressions = []
+    print('{:<36} {:>12} {:>12} {:>8} {:>10}'.format('benchmark', 'min (us)', 'median (us)', 'spread', 'vs base'))
+    for name, function in cases.items():
+        if args.keyword and args.keyword not in name:
+            continue
+        result = measure(function, args.min_time, args.repeat)
+        change = ''
+        if name in baseline:
+            ratio, slower = slowdown(result, baseline[name], args.threshold)
+            for _ in range(args.retries):
+                if not slower:
+                    break
+                retry = measure(function, args.min_time, args.repeat)
+                if retry['median'] < result['median']:
+                    result = retry
+                ratio, slower = slowdown(result, baseline[name], args.threshold)
+            change = '{:+.1f}%'.format((ratio - 1) * 100)
+            if slower:
+                regressions.append(name)
+                change += ' !'
+        results[name] = result
+        print('{:<36} {:>12.2f} {:>12.2f} {:>7.1f}% {:>10}'.format(
+            name, result['min'] * 1e6, result['median'] * 1e6, result['spread'] * 100, change))
+    chat.db.close()
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(machine, saved=time(), results=results), f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+
+    if regressions:
+        print('{} benchmarks slower than the baseline by more than {}%: {}'.format(
+            len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+#!/bin/env python3
+"""Multi-process load generator driving a real Chat server over websockets.
+
+Clients speak the chat protocol through benchmarks/wsclient.py ('0'/'1' frames, request_ids,
+the key_iv handshake and AES-CFB from websocketchat.crypto, optionally the msgpack format and
+permessage-deflate). Scenarios:
+
+    connect_storm  - connections opened as fast as possible (handshake + key_iv)
+    login          - login requests with the password
+    token_login    - token_login requests, every response hands out the next token
+    deep_history   - enter_room of a room with a long history
+    fanout         - messages sent to rooms of many members, latency until every member has it
+
+By default a server is started with a scratch database holding the users and the history,
+--port/--host with --no-server drive a running server instead (--db then names its database
+so the users can be created in it).
+
+usage: python3 benchmarks/loadgen <scenario|all> [options], see --help
+
+Results are printed (or written with --output) as JSON, latencies in ms:
+    {"scenario": "login", "operations": 4000, "errors": 0, "elapsed_s": 2.1,
+     "throughput_per_s": 1904.7, "latency_ms": {"p50": ..., "p99": ..., "p999": ..., ...}, ...}
+"""
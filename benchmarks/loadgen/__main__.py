@@ -0,0 +1,104 @@
+#!/bin/env python3
+import os
+import sys
+import json
+import argparse
+import tempfile
+import multiprocessing
+here = os.path.dirname(os.path.abspath(__file__))
+# The package modules, wsclient and websocketchat
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', '..'))
+
+from scenarios import scenarios
+from server import Server, prepare_db
+from report import merge
+
+
+def client_process(scenario, config, index, barrier, results):
+    try:
+        results.put((index, scenarios[scenario](config, index, barrier)))
+    except Exception as e:
+        barrier.abort()
+        results.put((index, e))
+
+
+def run_scenario(scenario, config):
+    barrier = multiprocessing.Barrier(config['processes'])
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client_process, args=(scenario, config, i, barrier, results))
+                 for i in range(config['processes'])]
+    for process in processes:
+        process.start()
+
+    collected = []
+    failed = []
+    for _ in processes:
+        index, outcome = results.get()
+        if isinstance(outcome, Exception):
+            failed.append('process {}: {!r}'.format(index, outcome))
+        else:
+            collected.append(outcome)
+    for process in processes:
+        process.join()
+
+    if failed:
+        return {'scenario': scenario, 'config': config, 'failed': failed}
+    return merge(scenario, config, collected)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='loadgen', description='Load generator for the chat server')
+    parser.add_argument('scenario', choices=sorted(scenarios) + ['all'])
+    parser.add_argument('--processes', type=int, default=4, help='client processes')
+    parser.add_argument('--connections', type=int, default=50, help='connections per process')
+    parser.add_argument('--rounds', type=int, default=20, help='requests per connection')
+    parser.add_argument('--rooms', type=int, default=4, help='fanout: rooms the connections are spread over')
+    parser.add_argument('--messages', type=int, default=50, help='fanout: messages per sender')
+    parser.add_argument('--rate', type=float, default=20, help='fanout: messages per second per sender')
+    parser.add_argument('--idle-timeout', type=float, default=2, help='fanout: seconds without messages to stop')
+    parser.add_argument('--history', type=int, default=100000, help='messages in the deep_history room')
+    parser.add_argument('--history-size', type=int, default=100, help='server history kept per room')
+    parser.add_argument('--format', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--compression', action='store_true', help='offer permessage-deflate')
+    parser.add_argument('--engine', choices=['asyncio', 'ewebsockets'], default='asyncio')
+    parser.add_argument('--workers', type=int, default=1, help='server processes (Supervisor)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25700)
+    parser.add_argument('--no-server', action='store_true', help='drive a server that is already running')
+    parser.add_argument('--db', help='database of the server, a scratch database by default')
+    parser.add_argument('--output', help='write the results here instead of printing them')
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in ('processes', 'connections', 'rounds', 'rooms', 'messages',
+                                                     'rate', 'idle_timeout', 'history', 'history_size', 'format',
+                                                     'compression', 'engine', 'workers', 'host', 'port')}
+    config['db'] = args.db or os.path.join(tempfile.mkdtemp(), 'loadgen.db')
+    if not args.no_server or args.db:
+        prepare_db(config['db'], args.processes * args.connections, args.history)
+
+    server = None
+    if not args.no_server:
+        server = Server(config)
+        server.start()
+
+    results = []
+    try:
+        for scenario in (sorted(scenarios) if args.scenario == 'all' else [args.scenario]):
+            results.append(run_scenario(scenario, config))
+            print('{}: done'.format(scenario), file=sys.stderr)
+    finally:
+        if server is not None:
+            server.stop()
+
+    text = json.dumps(results if args.scenario == 'all' else results[0], indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
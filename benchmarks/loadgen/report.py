@@ -0,0 +1,41 @@
+#!/bin/env python3
+"""Merges the results of the client processes into one machine readable result"""
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    rank = max(1, int(len(ordered) * p / 100 + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(latencies):
+    """latencies in seconds, the summary in ms"""
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'p50': None, 'p99': None, 'p999': None, 'mean': None, 'min': None, 'max': None}
+    return {'p50': round(percentile(ordered, 50) * 1000, 3),
+            'p99': round(percentile(ordered, 99) * 1000, 3),
+            'p999': round(percentile(ordered, 99.9) * 1000, 3),
+            'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+            'min': round(ordered[0] * 1000, 3),
+            'max': round(ordered[-1] * 1000, 3)}
+
+
+def merge(scenario, config, results):
+    """results are the dicts returned by the scenario in every client process"""
+    latencies = []
+    for result in results:
+        latencies.extend(result['latencies'])
+    started = min(result['started'] for result in results)
+    finished = max(result['finished'] for result in results)
+    elapsed = finished - started
+    operations = sum(result['operations'] for result in results)
+    return {'scenario': scenario,
+            'config': config,
+            'operations': operations,
+            'errors': sum(result['errors'] for result in results),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(operations / elapsed, 1) if elapsed > 0 else None,
+            'bytes_received': sum(result['bytes_received'] for result in results),
+            'latency_ms': latency_summary(latencies)}
@@ -0,0 +1,206 @@
+#!/bin/env python3
+"""The scenarios, each runs in every client process as scenario(config, index, barrier) and
+returns {'latencies': [seconds, ...], 'operations', 'errors', 'bytes_received', 'started', 'finished'}
+
+config is the dict built by __main__ with the per process number of connections, index is the
+number of the process. The processes wait on barrier once their connections are set up.
+"""
+
+import select
+from time import perf_counter, time
+from wsclient import ChatClient
+
+PASSWORD = 'password'
+HISTORY_ROOM = 'history.loadgen.test'
+
+
+def email(user):
+    return 'user{}@loadgen.test'.format(user)
+
+
+def result(latencies, operations, errors, clients, started, finished):
+    return {'latencies': latencies,
+            'operations': operations,
+            'errors': errors,
+            'bytes_received': sum(client.bytes_received for client in clients),
+            'started': started,
+            'finished': finished}
+
+
+def wait_for(client, type_id):
+    """Returns the array of the next message of type_id, skipping everything else"""
+    while True:
+        message_type, array = client.recv_message()
+        if message_type == type_id:
+            return array
+        if message_type == 'v':
+            raise TimeoutError('Request {} timed out on the server'.format(array))
+
+
+def connect(config):
+    client = ChatClient(config['host'], config['port'], compression=config['compression'])
+    if config['format'] != 'json':
+        client.set_format(config['format'])
+        wait_for(client, 'e')
+    return client
+
+
+def login(client, user, request_token=0):
+    client.request('3', [1, email(user), PASSWORD, request_token], enc=True)
+    return wait_for(client, '3')
+
+
+def connect_all(config, index, logged_in=False, request_token=0):
+    clients = []
+    tokens = []
+    for i in range(config['connections']):
+        client = connect(config)
+        if logged_in:
+            response = login(client, index * config['connections'] + i, request_token)
+            tokens.append(response[4])
+        clients.append(client)
+    return clients, tokens
+
+
+def close_all(clients):
+    for client in clients:
+        client.close()
+
+
+def connect_storm(config, index, barrier):
+    barrier.wait()
+    clients = []
+    latencies = []
+    errors = 0
+    started = time()
+    for _ in range(config['connections']):
+        t0 = perf_counter()
+        try:
+            # Done once the key_iv message has arrived
+            clients.append(connect(config))
+        except (OSError, ConnectionError):
+            errors += 1
+            continue
+        latencies.append(perf_counter() - t0)
+    finished = time()
+    close_all(clients)
+    return result(latencies, len(latencies), errors, clients, started, finished)
+
+
+def request_loop(config, clients, barrier, send, expect):
+    """Every client does config['rounds'] requests, one at a time"""
+    barrier.wait()
+    latencies = []
+    errors = 0
+    started = time()
+    for _ in range(config['rounds']):
+        for i, client in enumerate(clients):
+            t0 = perf_counter()
+            send(i, client)
+            try:
+                if not expect(i, wait_for(client, expect.type_id)):
+                    errors += 1
+            except TimeoutError:
+                errors += 1
+            latencies.append(perf_counter() - t0)
+    finished = time()
+    close_all(clients)
+    return result(latencies, len(latencies), errors, clients, started, finished)
+
+
+def login_scenario(config, index, barrier):
+    clients, _ = connect_all(config, index)
+
+    def send(i, client):
+        client.request('3', [1, email(index * config['connections'] + i), PASSWORD, 0], enc=True)
+
+    def expect(i, response):
+        return response[1] == 1
+    expect.type_id = '3'
+    return request_loop(config, clients, barrier, send, expect)
+
+
+def token_login(config, index, barrier):
+    clients, tokens = connect_all(config, index, logged_in=True, request_token=1)
+
+    def send(i, client):
+        client.request('b', [2, email(index * config['connections'] + i), tokens[i]], enc=True)
+
+    def expect(i, response):
+        # The token is rotated on every token_login
+        if response[1] != 1:
+            return False
+        tokens[i] = response[4]
+        return True
+    expect.type_id = 'b'
+    return request_loop(config, clients, barrier, send, expect)
+
+
+def deep_history(config, index, barrier):
+    clients, _ = connect_all(config, index)
+
+    def send(i, client):
+        client.request('6', [3, HISTORY_ROOM, 0])
+
+    def expect(i, response):
+        return len(response[1]) > 0
+    expect.type_id = '6'
+    return request_loop(config, clients, barrier, send, expect)
+
+
+def fanout(config, index, barrier):
+    """Every connection joins one of config['rooms'] rooms, the first connection of each room in
+    every process sends config['messages'] messages at config['rate'] per second. The latency is
+    from sending until a member has the message, over all members"""
+    clients, _ = connect_all(config, index, logged_in=True)
+    rooms = config['rooms']
+    for i, client in enumerate(clients):
+        client.request('6', [4, 'room{}.loadgen.test'.format((index * config['connections'] + i) % rooms), 2**62])
+        wait_for(client, '6')
+    senders = clients[:rooms]
+
+    barrier.wait()
+    latencies = []
+    errors = 0
+    started = time()
+    interval = 1 / config['rate'] if config['rate'] > 0 else 0
+    sent = 0
+    next_send = perf_counter()
+    last_received = perf_counter()
+    while True:
+        now = perf_counter()
+        if sent < config['messages'] and now >= next_send:
+            for sender in senders:
+                # The wall clock is shared by the processes on the machine
+                sender.request('1', [5 + sent, 'loadgen {!r}'.format(time())])
+            sent += 1
+            next_send += interval
+        elif sent >= config['messages'] and now - last_received > config['idle_timeout']:
+            break
+
+        wait = max(0, next_send - perf_counter()) if sent < config['messages'] else config['idle_timeout']
+        readable, _, _ = select.select(clients, [], [], wait)
+        for client in readable:
+            client.fill()
+            # A frame cut in half is completed by the blocking read in recv_frame
+            while len(client.buffer) >= 2:
+                message_type, array = client.recv_message()
+                if message_type == 'z':
+                    received = time()
+                    try:
+                        latencies.append(received - float(array[3].split(' ', 1)[1]))
+                    except (ValueError, IndexError):
+                        errors += 1
+                    last_received = perf_counter()
+                elif message_type == 'v':
+                    errors += 1
+    finished = time() - config['idle_timeout']
+    close_all(clients)
+    return result(latencies, len(latencies), errors, clients, started, finished)
+
+
+scenarios = {'connect_storm': connect_storm,
+             'login': login_scenario,
+             'token_login': token_login,
+             'deep_history': deep_history,
+             'fanout': fanout}
@@ -0,0 +1,79 @@
+#!/bin/env python3
+"""Scratch database and server for the load generator"""
+
+import socket
+import logging
+import multiprocessing
+from time import time, sleep, perf_counter
+
+import websocketchat
+from websocketchat.database import ChatDb
+from scenarios import PASSWORD, HISTORY_ROOM, email
+
+
+def prepare_db(path, users, history):
+    """Creates the users (unless they exist) and fills the history room up to history messages"""
+    db = ChatDb(path)
+    existing = db.execute('''SELECT COUNT(*) FROM users WHERE email LIKE '%@loadgen.test' ''', fetch='one')[0]
+    for user in range(existing, users):
+        user_id, _ = db.new_user(email(user), 'User{}'.format(user), PASSWORD)
+        db.remove_verification_code(user_id)
+
+    count = db.execute('''SELECT COUNT(*) FROM messages WHERE room_name = ?''', (HISTORY_ROOM, ), fetch='one')[0]
+    if count < history:
+        t = time()
+        rows = [('User{}'.format(i % 50), 'History message number {}'.format(i), HISTORY_ROOM, 1, t)
+                for i in range(count, history)]
+        with db.transaction() as cursor:
+            cursor.executemany('''INSERT INTO messages(user, text, room_name, show, time) VALUES(?, ?, ?, ?, ?)''',
+                               rows)
+    db.close()
+
+
+def serve(config, stop):
+    logging.basicConfig(level=logging.WARNING)
+    kwargs = {'port': config['port'],
+              'history_size': config['history_size'],
+              'db_kwargs': {'name': config['db']}}
+    if config['compression']:
+        kwargs['compression_kwargs'] = {}
+    if config.get('capture'):
+        kwargs['capture_kwargs'] = {'path': config['capture'], 'redact': ()}
+    if config['workers'] > 1:
+        server = websocketchat.Supervisor(workers=config['workers'], **kwargs)
+    else:
+        server = websocketchat.Chat(engine=config['engine'], **kwargs)
+    server.start()
+    stop.wait()
+    server.stop()
+
+
+def wait_until_listening(host, port, timeout=30):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError('Server on {}:{} did not come up'.format(host, port))
+
+
+class Server:
+    def __init__(self, config):
+        self.config = config
+        self.stop_event = multiprocessing.Event()
+        self.process = None
+
+    def start(self):
+        if self.config['compression'] and self.config['engine'] != 'asyncio' and self.config['workers'] <= 1:
+            raise ValueError('--compression needs --engine asyncio')
+        self.process = multiprocessing.Process(target=serve, args=(self.config, self.stop_event))
+        self.process.start()
+        wait_until_listening(self.config['host'], self.config['port'])
+
+    def stop(self):
+        self.stop_event.set()
+        self.process.join(30)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,281 @@
+#!/bin/env python3
+"""Replays a capture (see websocketchat/capture.py) against a server with a scratch database
+and compares the latencies with the recording.
+
+    python3 benchmarks/replay.py traffic.cap                 at the original speed
+    python3 benchmarks/replay.py traffic.cap --speed 10      ten times faster, 0 as fast as possible
+    python3 benchmarks/replay.py traffic.cap --db chat.db    on a copy of chat.db instead of an empty one
+
+Every recorded connection gets its own connection and sends its requests at the recorded time
+(divided by --speed), encrypted if they were. The users that log in without registering in the
+capture are created first, with the (pseudonym) password and tokens they use. Rooms start
+empty unless --db is given.
+
+The replay server captures as well, so the result compares the server side latency (request
+read until response sent) per request type of the recording and the replay. round_trip_ms is
+the latency the replaying clients saw and schedule_lag_ms how late the requests were sent.
+"""
+
+import os
+import sys
+import json
+import shutil
+import select
+import argparse
+import tempfile
+from time import time, perf_counter
+from collections import defaultdict, deque
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, 'loadgen'))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..'))
+
+from websocketchat.capture import read_sessions
+from websocketchat.crypto import hash
+from websocketchat.database import ChatDb
+from websocketchat.forms import request_ids
+from wsclient import ChatClient
+from server import Server
+from report import latency_summary
+
+
+def requests_of(records):
+    """(request_id, request_array) of every request, the sub-requests of batches included"""
+    for record in records:
+        if record[0] != 'r':
+            continue
+        request_id, request_array = record[3], record[4]
+        if request_id == 'f':
+            for request in request_array[1:]:
+                yield request[0], request[1:]
+        else:
+            yield request_id, request_array
+
+
+def seed_db(path, records):
+    """Creates the users that log in without registering first"""
+    registered = set()
+    passwords = {}
+    tokens = defaultdict(set)
+    for request_id, request_array in requests_of(records):
+        if request_id == '9':
+            registered.add(request_array[1].lower())
+        elif request_id == '3' and request_array[1].lower() not in registered:
+            passwords.setdefault(request_array[1].lower(), request_array[2])
+        elif request_id == 'b' and request_array[1].lower() not in registered:
+            tokens[request_array[1].lower()].add(request_array[2])
+
+    db = ChatDb(path)
+    t = time()
+    for n, email in enumerate(sorted(set(passwords) | set(tokens))):
+        if db.check_existence('users', 'email', email):
+            continue
+        user_id, _ = db.new_user(email, 'Replay{}'.format(n), passwords.get(email, 'password'))
+        db.remove_verification_code(user_id)
+        with db.transaction() as cursor:
+            for token in tokens[email]:
+                cursor.execute('''INSERT INTO tokens(user_id, token_hash, created, expires) VALUES(?, ?, ?, ?)''',
+                               (user_id, hash(token), t, t + db.token_lifetime))
+    db.close()
+    return len(set(passwords) | set(tokens))
+
+
+def server_latencies(records):
+    """{request_id: [seconds, ...]} from the request and response records of a capture"""
+    sent = defaultdict(deque)
+    latencies = defaultdict(list)
+    for record in records:
+        if record[0] == 'r':
+            sent[(record[2], record[3], record[4][0])].append(record[1])
+        elif record[0] == 's':
+            times = sent.get((record[2], record[3], record[4]))
+            if times:
+                latencies[record[3]].append(record[1] - times.popleft())
+    return latencies
+
+
+class Replay:
+    def __init__(self, records, host, port, speed=1, grace=2):
+        self.records = records
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.grace = grace
+        self.clients = {}  # {recorded connection: ChatClient}
+        self.connections = {}  # {ChatClient: recorded connection}
+        self.closing = {}  # {recorded connection: time to close it even if responses are missing}
+        # {(connection, request_id, msg_id): deque of send times}, msg ids can be reused
+        self.outstanding = defaultdict(deque)
+        self.outstanding_count = defaultdict(int)
+        self.round_trips = defaultdict(list)
+        self.lags = []
+        self.timeouts = 0
+        self.errors = 0
+
+    def run(self):
+        start = perf_counter()
+        for record in self.records:
+            kind = record[0]
+            if kind not in ('o', 'r', 'c'):
+                continue
+            due = start + record[1] / self.speed if self.speed > 0 else 0
+            self.wait(due)
+            if due:
+                self.lags.append(max(0, perf_counter() - due))
+
+            connection = record[2]
+            if kind == 'o':
+                try:
+                    client = ChatClient(self.host, self.port)
+                except (OSError, ConnectionError):
+                    self.errors += 1
+                    continue
+                self.clients[connection] = client
+                self.connections[client] = connection
+            elif kind == 'r':
+                self.send(connection, record[3], record[4], record[5])
+            else:
+                self.closing[connection] = perf_counter() + self.grace
+
+        # The responses still on their way
+        deadline = perf_counter() + self.grace
+        while sum(self.outstanding_count.values()) and perf_counter() < deadline:
+            self.wait(perf_counter() + 0.05)
+        for connection in list(self.clients):
+            self.close(connection)
+
+    def send(self, connection, request_id, request_array, enc):
+        client = self.clients.get(connection)
+        if client is None:
+            return
+        try:
+            client.request(request_id, request_array, enc=bool(enc))
+        except OSError:
+            self.errors += 1
+            self.close(connection)
+            return
+        if request_id == 'e' and request_array[1] in ('json', 'msgpack'):
+            client.format = request_array[1]
+        self.outstanding[(connection, request_id, request_array[0])].append(perf_counter())
+        self.outstanding_count[connection] += 1
+
+    def answered(self, connection, request_id, msg_id):
+        times = self.outstanding.get((connection, request_id, msg_id))
+        if not times:
+            return None
+        self.outstanding_count[connection] -= 1
+        return perf_counter() - times.popleft()
+
+    def wait(self, until):
+        """Reads what the server sends until the time until"""
+        while True:
+            for connection, close_at in list(self.closing.items()):
+                if self.outstanding_count[connection] <= 0 or perf_counter() >= close_at:
+                    self.close(connection)
+            timeout = until - perf_counter()
+            readable, _, _ = select.select(list(self.connections), [], [], max(0, timeout))
+            for client in readable:
+                self.read(client)
+            if timeout <= 0:
+                return
+
+    def read(self, client):
+        connection = self.connections[client]
+        try:
+            client.fill()
+            # A frame cut in half is completed by the blocking read in recv_frame
+            while len(client.buffer) >= 2:
+                type_id, array = client.recv_message()
+                if type_id in request_ids:
+                    latency = self.answered(connection, type_id, array[0])
+                    if latency is not None:
+                        self.round_trips[type_id].append(latency)
+                elif type_id == 'v':
+                    self.timeouts += 1
+                    self.answered(connection, array[1], array[0])
+        except (OSError, ConnectionError):
+            self.errors += 1
+            self.close(connection)
+
+    def close(self, connection):
+        self.closing.pop(connection, None)
+        client = self.clients.pop(connection, None)
+        if client is not None:
+            del self.connections[client]
+            client.close()
+
+
+def compare(recorded, replayed, round_trips):
+    result = {}
+    for request_id in sorted(set(recorded) | set(replayed)):
+        before = latency_summary(recorded.get(request_id, []))
+        after = latency_summary(replayed.get(request_id, []))
+        drift = {p: round(after[p] - before[p], 3) if before[p] is not None and after[p] is not None else None
+                 for p in ('p50', 'p99')}
+        result[request_ids[request_id]['type']] = {'recorded_responses': len(recorded.get(request_id, [])),
+                                                   'replayed_responses': len(replayed.get(request_id, [])),
+                                                   'recorded_ms': before,
+                                                   'replayed_ms': after,
+                                                   'drift_ms': drift,
+                                                   'round_trip_ms': latency_summary(round_trips.get(request_id, []))}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a capture against a scratch server')
+    parser.add_argument('capture')
+    parser.add_argument('--session', type=int, default=-1, help='session in the capture file, the last by default')
+    parser.add_argument('--speed', type=float, default=1, help='speed up factor, 0 sends as fast as possible')
+    parser.add_argument('--grace', type=float, default=2, help='seconds to wait for missing responses')
+    parser.add_argument('--db', help='start from a copy of this database')
+    parser.add_argument('--history-size', type=int, default=100, help='server history kept per room')
+    parser.add_argument('--engine', choices=['asyncio', 'ewebsockets'], default='asyncio')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25700)
+    parser.add_argument('--output', help='write the results here instead of printing them')
+    args = parser.parse_args()
+
+    records = read_sessions(args.capture)[args.session]
+    scratch = tempfile.mkdtemp()
+    db_path = os.path.join(scratch, 'replay.db')
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    seeded = seed_db(db_path, records)
+
+    config = {'port': args.port, 'host': args.host, 'history_size': args.history_size, 'db': db_path,
+              'compression': False, 'engine': args.engine, 'workers': 1,
+              'capture': os.path.join(scratch, 'replay.cap')}
+    server = Server(config)
+    server.start()
+    replay = Replay(records, args.host, args.port, args.speed, args.grace)
+    started = perf_counter()
+    try:
+        replay.run()
+    finally:
+        server.stop()
+    elapsed = perf_counter() - started
+
+    replayed = read_sessions(config['capture'])[-1]
+    result = {'capture': args.capture,
+              'speed': args.speed,
+              'seeded_users': seeded,
+              'connections': sum(1 for record in records if record[0] == 'o'),
+              'requests': sum(1 for record in records if record[0] == 'r'),
+              'recorded_s': round(records[-1][1], 3),
+              'elapsed_s': round(elapsed, 3),
+              'timeouts': replay.timeouts,
+              'errors': replay.errors,
+              'schedule_lag_ms': latency_summary(replay.lags),
+              'requests_by_type': compare(server_latencies(records), server_latencies(replayed), replay.round_trips)}
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/bin/env python3
+"""Join/leave churn on rooms.
+
+The first part compares removing members from a big room stored as a list (the old
+ChatRoom.clients) with the insertion ordered dict used now. The second part drives
+Chat.handle_request_enter_room/leave_room from several threads over a few rooms and
+reports joins+leaves per second.
+
+usage: python3 benchmarks/room_churn.py [members] [threads]
+"""
+
+import os
+import sys
+import random
+import tempfile
+import threading
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import websocketchat
+from websocketchat.chat_room import ChatRoom
+from websocketchat.client import Client
+
+
+class NullWebsocket:
+    def __init__(self, i):
+        self.address = ('127.0.0.1', i)
+
+    def send_text(self, text, timeout=-1):
+        return len(text)
+
+
+def make_clients(n, offset=0):
+    clients = []
+    for i in range(n):
+        client = Client(websocket=NullWebsocket(offset + i), send_executor=None)
+        client.name = 'User{}'.format(offset + i)
+        clients.append(client)
+    return clients
+
+
+def churn_list(clients):
+    members = list(clients)
+    order = list(clients)
+    random.shuffle(order)
+    t0 = perf_counter()
+    for client in order:
+        members.remove(client)
+        members.append(client)
+    return perf_counter() - t0
+
+
+def churn_room(clients):
+    room = ChatRoom('example.com', 1)
+    for client in clients:
+        room.add_client(client)
+    order = list(clients)
+    random.shuffle(order)
+    t0 = perf_counter()
+    for client in order:
+        room.remove_client(client)
+        room.add_client(client)
+    return perf_counter() - t0
+
+
+def churn_chat(chat, clients, rooms, duration=2.0):
+    operations = [0]
+    lock = threading.Lock()
+    stop = perf_counter() + duration
+
+    def worker(own_clients):
+        done = 0
+        while perf_counter() < stop:
+            for client in own_clients:
+                chat.handle_request_enter_room(client, random.choice(rooms), 2**62)
+                done += 1
+            for client in own_clients:
+                chat.leave_room(client)
+                done += 1
+        with lock:
+            operations[0] += done
+
+    threads = [threading.Thread(target=worker, args=(clients[i::len(rooms)],)) for i in range(len(rooms))]
+    t0 = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return operations[0] / (perf_counter() - t0)
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    clients = make_clients(members)
+    list_time = churn_list(clients)
+    room_time = churn_room(clients)
+    print('{} members, each leaving and rejoining once'.format(members))
+    print('  list: {:>10.0f} leaves+joins/s'.format(2 * members / list_time))
+    print('  room: {:>10.0f} leaves+joins/s'.format(2 * members / room_time))
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    chat = websocketchat.Chat(db_kwargs={'name': path})
+    rooms = ['room{}.com'.format(i) for i in range(threads)]
+    rate = churn_chat(chat, make_clients(threads * 500, offset=members), rooms)
+    print('Chat with {} threads over {} rooms: {:.0f} joins+leaves/s'.format(threads, len(rooms), rate))
+    chat.db.close()
+
+
+if __name__ == '__main__':
+    main()
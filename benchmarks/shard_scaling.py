@@ -0,0 +1,115 @@
+#!/bin/env python3
+"""Broadcast throughput of a Supervisor with a growing number of worker processes.
+
+Every connection logs in as its own user and enters one of a few rooms, then one member
+of every room and client process sends messages. The result is delivered room messages
+per second over all connections.
+
+usage: python3 benchmarks/shard_scaling.py [max_workers] [connections] [messages]
+"""
+
+import os
+import sys
+import select
+import tempfile
+import multiprocessing
+from time import perf_counter, sleep
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat import Supervisor
+from websocketchat.database import ChatDb
+from wsclient import ChatClient
+
+PORT = 25700
+ROOMS = ['room{}.com'.format(i) for i in range(4)]
+CLIENT_PROCESSES = 4
+
+
+def create_users(db_path, n):
+    db = ChatDb(db_path)
+    for i in range(n):
+        user_id, _ = db.new_user('user{}@bench.test'.format(i), 'User{}'.format(i), 'password')
+        db.remove_verification_code(user_id)
+    db.close()
+
+
+def client_process(port, first_user, connections, messages, barrier, results):
+    clients = []
+    for i in range(connections):
+        client = ChatClient(port=port)
+        user = first_user + i
+        client.request('3', [1, 'user{}@bench.test'.format(user), 'password', 0])
+        client.request('6', [2, ROOMS[user % len(ROOMS)], 2**62])
+        clients.append(client)
+
+    for client in clients:
+        answered = set()
+        while answered != {'3', '6'}:
+            answered.add(client.recv_message()[0])
+    barrier.wait()
+    t0 = perf_counter()
+    senders = clients[:len(ROOMS)]
+    for i in range(messages):
+        for sender in senders:
+            sender.request('1', [3 + i, 'message {}'.format(i)])
+
+    received = 0
+    last = t0
+    while True:
+        readable, _, _ = select.select(clients, [], [], 2)
+        if not readable:
+            break
+        for client in readable:
+            client.fill()
+            # A frame cut in half is completed by the blocking read in recv_frame
+            while len(client.buffer) >= 2:
+                # Skipping the responses to the senders' own send_message requests
+                if client.recv_message()[0] == 'z':
+                    received += 1
+                    last = perf_counter()
+    results.put((received, last - t0))
+    for client in clients:
+        client.close()
+
+
+def run(workers, connections, messages):
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    create_users(db_path, connections)
+    supervisor = Supervisor(workers=workers, port=PORT, db_kwargs={'name': db_path})
+    supervisor.start()
+    sleep(1)
+
+    per_process = connections // CLIENT_PROCESSES
+    barrier = multiprocessing.Barrier(CLIENT_PROCESSES)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client_process,
+                                         args=(PORT, i * per_process, per_process, messages, barrier, results))
+                 for i in range(CLIENT_PROCESSES)]
+    for process in processes:
+        process.start()
+    received, elapsed = 0, 0
+    for _ in processes:
+        r, e = results.get()
+        received += r
+        elapsed = max(elapsed, e)
+    for process in processes:
+        process.join()
+    supervisor.stop()
+    return received, elapsed
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    print('{:>8} {:>12} {:>14}'.format('workers', 'delivered', 'messages/s'))
+    workers = 1
+    while workers <= max_workers:
+        received, elapsed = run(workers, connections, messages)
+        print('{:>8} {:>12} {:>14.0f}'.format(workers, received, received / elapsed if elapsed else 0))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/bin/env python3
+"""forms.validate_request over a corpus of valid and invalid frames.
+
+Compares the validators compiled per request id with the previous version, which
+walked the request_ids dict for every request, compiled the email regex on every
+call and checked room names with validators.url (copied below as old_validate_request).
+Both have to give the same results, room names are also compared over room_names.
+
+usage: python3 benchmarks/validate_request.py [rounds]
+"""
+
+import os
+import re
+import sys
+import json
+import validators
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat import forms
+from websocketchat.forms import request_ids, validate_request, is_str, is_url
+
+corpus = [
+    # Valid
+    '1[1, "Hello there, how is everyone doing today?"]',
+    '3[2, "someone@example.com", "hunter2", 1]',
+    '6[3, "example.com/lobby", 0]',
+    '6[4, "127.0.0.1:8080/room", 1500]',
+    '7[5, "Someone42"]',
+    '8[6, "someone@example.com"]',
+    '9[7, "someone@example.com", "Someone42", "hunter2"]',
+    'a[8, "123456"]',
+    'b[9, "someone@example.com", "{}"]'.format('0f' * 32),
+    'c[10, "{}"]'.format('0f' * 32),
+    'd[11]',
+    # Invalid
+    'x',
+    'q[1]',
+    '1[1, "unterminated',
+    '1{"msg_id": 1}',
+    '1[]',
+    '1["1", "text"]',
+    '1[1, "text", "extra"]',
+    '3[2, "not an email", "hunter2", 1]',
+    '3[2, "someone@example.com", "hunter2", 2]',
+    '6[3, "no spaces allowed", 0]',
+    '6[4, "localhost:8080/room", 1500]',
+    '7[5, "1abc"]',
+]
+
+# Edge cases of the room name (url) rules
+room_names = [
+    'example.com', 'EXAMPLE.com/Lobby', 'example.co.uk', 'xn--80ak6aa92e.com', 'a.xn--p1ai',
+    '\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444', 'localhost.localdomain', 'example.c0m',
+    'a.co1', 'localhost', 'localhost:8080/room', 'foo_bar', 'foo_bar.example.com', '_foo.example.com',
+    'a__b.com', 'example.com.', 'example..com', '-a.com', 'a-.com', 'a' * 64 + '.com',
+    'example.com:1', 'example.com:65535', 'example.com:0', 'example.com:65536', 'example.com:99999',
+    'example.com:', 'example.com:/x', 'example.com:8080:9',
+    '127.0.0.1', '127.0.0.1:80/x', '0.0.0.0', '999.1.1.1', '1.2.3.4.5', '01.2.3.4',
+    '[::1]', '[::1]:8080', '[2001:db8::1]/x', '[::ffff:1.2.3.4]', '[fe80::1%eth0]', '::1', '[::1', '[::1]x',
+    '[v1.fe]', 'user@example.com', 'user:pw@example.com', ':pw@example.com', '@example.com',
+    'a:b:c@example.com', 'user@name@example.com', '"q"@example.com', '\u00fc@example.com',
+    '\u0100bc@example.com', 'example.com/lobby', 'example.com//a', 'example.com/\u00fc',
+    'example.com/<>', 'example.com/"', 'example.com?x=1', 'example.com?x', 'example.com?a=1&b',
+    'example.com?a=1;b=2', 'example.com?', 'example.com#f', 'example.com?x=1#f', 'example.com#<',
+    'ex ample.com', 'example.com/with space', 'http://example.com', '', '/lobby',
+]
+
+
+def old_is_url(input):
+    input = 'http://' + input
+    if not is_str(input):
+        return False
+
+    return validators.url(input) == True
+
+
+def old_is_email(input):
+    if not is_str(input):
+        return False
+
+    regex = r'^(([^<>()\[\]\\.,;:\s@"]+(\.[^<>()\[\]\\.,;:\s@"]+)*)|(".+"))@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}])|(([a-zA-Z\-0-9]+\.)+[a-zA-Z]{2,}))$'
+    pattern = re.compile(regex)
+
+    if not pattern.match(input):
+        return False
+
+    return True
+
+
+def old_validate_username(input):
+    if not is_str(input):
+        return False
+
+    if len(input) < 3 or len(input) > 15:
+        return False
+
+    if not re.match('^[A-Za-z][A-Za-z0-9]*$', input):
+        return False
+
+    return True
+
+
+old_replacements = {forms.is_email: old_is_email,
+                    forms.validate_username: old_validate_username,
+                    forms.is_url: old_is_url}
+
+
+def old_validate_request(request):
+    if len(request) < 4:
+        return False, 'Request length < 4 (minimum e.x. "1[1]"'
+
+    request_id = request[0]
+    if request_id not in request_ids:
+        return False, 'Invalid request id'
+
+    req = request_ids[request_id]
+    try:
+        request_array = json.JSONDecoder().decode(request[1:])
+    except json.JSONDecodeError:
+        return False, 'Failed to convert request_array to list in request {}'.format(req['type'])
+
+    if type(request_array) != list:
+        return False, 'request_array is not of type<list> after conversion in request {}'.format(req['type'])
+
+    if len(request_array) == 0:
+        return False, 'request_array is missing an msg_id in request {}'.format(req['type'])
+
+    if type(request_array[0]) != int:
+        return False, 'msg_id is of wrong type or missing in request {}'.format(req['type'])
+
+    if len(request_array) != req['expected_length'] + 1:
+        return False, 'Unexpected length in request {}'.format(req['type'])
+
+    for i in range(req['expected_length']):
+        validator = old_replacements.get(req['validators'][i], req['validators'][i])
+        if not validator(request_array[i+1]):
+            return False, 'Failed when validating {} ({}) of request {}'.format(
+                req['description'][i], request_array[i+1], req['type']
+            )
+
+    return True, [request_id, request_array]
+
+
+def run(function, rounds):
+    t0 = perf_counter()
+    for _ in range(rounds):
+        for request in corpus:
+            function(request)
+    return perf_counter() - t0
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for request in corpus:
+        if validate_request(request) != old_validate_request(request):
+            print('Results differ for {}: {} != {}'.format(
+                request, validate_request(request), old_validate_request(request)))
+            sys.exit(1)
+    for name in room_names:
+        if is_url(name) != old_is_url(name):
+            print('Results differ for room name {!r}: {} != {}'.format(name, is_url(name), old_is_url(name)))
+            sys.exit(1)
+
+    n = rounds * len(corpus)
+    old_time = run(old_validate_request, rounds)
+    new_time = run(validate_request, rounds)
+    valid = sum(1 for request in corpus if validate_request(request)[0])
+    print('{} requests ({} valid, {} invalid frames)'.format(n, valid, len(corpus) - valid))
+    print('  interpreted: {:>10.0f} requests/s'.format(n / old_time))
+    print('  compiled:    {:>10.0f} requests/s'.format(n / new_time))
+
+
+if __name__ == '__main__':
+    main()
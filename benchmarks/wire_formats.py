@@ -0,0 +1,76 @@
+#!/bin/env python3
+"""Bandwidth and CPU of the json and msgpack wire formats.
+
+For a few typical frames (a chat message request, a login request, a room message and the
+enter_room response with a full history) it reports the frame size and the time to encode
+and decode the frame, plaintext and encrypted with the client key.
+
+usage: python3 benchmarks/wire_formats.py [rounds] [history]
+"""
+
+import os
+import sys
+import json
+from time import perf_counter, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat import crypto
+from websocketchat.forms import EncodedJson
+from websocketchat.wire import encode_body, encode_frame, unpack
+
+
+def frames(history):
+    now = time()
+    messages = [[i, now + i, 'User{}'.format(i % 40), 'Message number {} in this room'.format(i)]
+                for i in range(history)]
+    return [
+        ('send_message', '1', [12, 'Hello there, how is everyone doing today?']),
+        ('login', '3', [13, 'someone@example.com', 'correct horse battery staple', 1]),
+        ('single_message', 'z', messages[-1]),
+        ('enter_room ({})'.format(history), '6', [14, EncodedJson(json.JSONEncoder().encode(messages))]),
+    ]
+
+
+def decode(format, frame, key, iv):
+    if format == 'msgpack':
+        body = frame[1:]
+        if frame[:1] == b'1':
+            body = crypto.decrypt(body, key, iv)
+        return chr(body[0]), unpack(body[1:])
+
+    text = frame[1:]
+    if frame[0] == '1':
+        text = crypto.decrypt(bytes.fromhex(text), key, iv).decode('utf-8')
+    return text[0], json.JSONDecoder().decode(text[1:])
+
+
+def measure(format, type_id, array, prefix, key, iv, rounds):
+    t0 = perf_counter()
+    for _ in range(rounds):
+        frame = encode_frame(format, encode_body(format, type_id, array), prefix, key, iv)
+    encode_time = (perf_counter() - t0) / rounds
+
+    t0 = perf_counter()
+    for _ in range(rounds):
+        decode(format, frame, key, iv)
+    decode_time = (perf_counter() - t0) / rounds
+    return len(frame), encode_time, decode_time
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    history = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    key, iv = crypto.generate_key_and_iv()
+
+    print('{:<22} {:<10} {:>9} {:>9} {:>12} {:>12}'.format(
+        'frame', 'format', 'mode', 'bytes', 'encode us', 'decode us'))
+    for name, type_id, array in frames(history):
+        for prefix, mode in (('0', 'plain'), ('1', 'encrypted')):
+            for format in ('json', 'msgpack'):
+                size, encode_time, decode_time = measure(format, type_id, array, prefix, key, iv, rounds)
+                print('{:<22} {:<10} {:>9} {:>9} {:>12.1f} {:>12.1f}'.format(
+                    name, format, mode, size, encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/bin/env python3
+"""Minimal blocking websocket client speaking the chat protocol, used by the benchmarks"""
+
+import os
+import sys
+import json
+import socket
+import struct
+import base64
+import zlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocketchat import crypto
+from websocketchat.wire import pack, unpack
+
+
+class ChatClient:
+    def __init__(self, host='127.0.0.1', port=25565, timeout=30, compression=False):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.room_key = None
+        self.format = 'json'
+        # Set when the server accepted permessage-deflate
+        self.extension = None
+        self.bytes_received = 0
+        self.handshake(host, port, compression)
+
+        # The server starts by sending the key and iv of the connection
+        type_id, array = self.recv_message()
+        self.key, self.iv = bytes.fromhex(array[0]), bytes.fromhex(array[1])
+        self.server_hello = array
+
+    def handshake(self, host, port, compression=False):
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = ('GET / HTTP/1.1\r\n'
+                   'Host: {}:{}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: {}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n').format(host, port, key)
+        if compression:
+            request += 'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+        request += '\r\n'
+        self.sock.sendall(request.encode())
+        while b'\r\n\r\n' not in self.buffer:
+            self.fill()
+        response, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError('Handshake refused: {}'.format(response.split(b'\r\n')[0]))
+        for line in response.decode('latin-1').split('\r\n'):
+            if line.lower().startswith('sec-websocket-extensions:'):
+                self.extension = line.split(':', 1)[1].strip()
+        # Keeping one decompressor works whether or not the server takes over the context
+        self.decompressor = zlib.decompressobj(-15)
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('Connection closed')
+        self.buffer += data
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            self.fill()
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def send_frame(self, payload, opcode=0x1):
+        first = 0x80 | opcode
+        if self.extension is not None and opcode < 0x8:
+            # Every message compressed on its own, the server may not keep the context
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            payload = (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            first |= 0x40
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', first, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', first, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', first, 0x80 | 127, length)
+        if length:
+            repeated = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+        self.sock.sendall(header + mask + payload)
+
+    def recv_frame(self):
+        """Returns (opcode, payload), ping frames are answered"""
+        while True:
+            first, second = self.read(2)
+            length = second & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', self.read(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', self.read(8))
+            payload = self.read(length)
+            self.bytes_received += length
+            opcode = first & 0x0F
+            if first & 0x40:
+                payload = self.decompressor.decompress(payload + b'\x00\x00\xff\xff')
+            if opcode == 0x9:
+                self.send_frame(payload, 0xA)
+                continue
+            if opcode == 0x8:
+                raise ConnectionError('Server closed the connection')
+            return opcode, payload
+
+    def set_format(self, format):
+        """Switches the wire format, the server uses it for everything after this request"""
+        self.request('e', [0, format])
+        self.format = format
+
+    def request(self, request_id, array, enc=False):
+        if self.format == 'msgpack':
+            body = request_id.encode() + pack(array)
+            if enc:
+                self.send_frame(b'1' + crypto.encrypt(body, self.key, self.iv), 0x2)
+            else:
+                self.send_frame(b'0' + body, 0x2)
+            return
+
+        text = request_id + json.JSONEncoder().encode(array)
+        if enc:
+            self.send_frame(b'1' + crypto.encrypt(text.encode(), self.key, self.iv).hex().encode())
+        else:
+            self.send_frame(b'0' + text.encode())
+
+    def decode(self, payload):
+        """Returns (type_id, array) of a text frame"""
+        text = payload.decode('utf-8')
+        if text[0] == '1':
+            text = crypto.decrypt(bytes.fromhex(text[1:]), self.key, self.iv).decode('utf-8')
+        elif text[0] == '2':
+            ciphertext = bytes.fromhex(text[1:])
+            text = crypto.decrypt(ciphertext[16:], self.room_key, ciphertext[:16]).decode('utf-8')
+        else:
+            text = text[1:]
+        type_id, array = text[0], json.JSONDecoder().decode(text[1:])
+        if type_id == 'x':
+            self.room_key = bytes.fromhex(array[0])
+        return type_id, array
+
+    def decode_binary(self, payload):
+        """Returns (type_id, array) of a binary frame"""
+        body = payload[1:]
+        if payload[:1] == b'1':
+            body = crypto.decrypt(body, self.key, self.iv)
+        elif payload[:1] == b'2':
+            body = crypto.decrypt(body[16:], self.room_key, body[:16])
+        type_id, array = chr(body[0]), unpack(body[1:])
+        if type_id == 'x':
+            self.room_key = bytes.fromhex(array[0])
+        return type_id, array
+
+    def recv_message(self):
+        opcode, payload = self.recv_frame()
+        if opcode == 0x2:
+            return self.decode_binary(payload)
+        return self.decode(payload)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
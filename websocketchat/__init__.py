@@ -2,6 +2,8 @@
 # import logging
 
 from websocketchat.chat_server import *
+from websocketchat.supervisor import Supervisor
+from websocketchat.log import start_logging, stop_logging
 
 
 with open(__path__[0] + '/version', 'r') as r:
@@ -0,0 +1,446 @@
+#!/bin/env python3
+"""asyncio implementation of the parts of ewebsockets.Websocket used by Chat
+
+Every connection is a coroutine instead of a thread so idle connections only cost a
+socket and a few objects. The Chat callbacks still block (database, crypto) so they
+are run in a thread pool, frames of one connection are handled one at a time and in order.
+
+permessage-deflate (RFC 7692) is negotiated when compression is on. Without server context
+takeover every message is compressed on its own, so a frame broadcast to many connections is
+compressed once and the result shared through compression_cache.
+"""
+
+import asyncio
+import threading
+import struct
+import base64
+import zlib
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+from ewebsockets import OpCode
+from .log import server_log, connection_log
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# Opcodes are handed to Chat as the ewebsockets values so both engines look the same
+opcodes = {OPCODE_TEXT: OpCode.TEXT,
+           OPCODE_BINARY: OpCode.BINARY}
+
+
+def status_code_value(status_code):
+    try:
+        return int(getattr(status_code, 'value', status_code))
+    except (TypeError, ValueError):
+        return 1000
+
+
+class Frame:
+    def __init__(self, opcode, payload):
+        self.opcode = opcode
+        self.payload = payload
+
+
+class HandshakeError(Exception):
+    pass
+
+
+class MessageTooBig(ValueError):
+    """The connection is failed with 1009 instead of 1002"""
+    pass
+
+
+def deflate(payload, level, wbits, compressor=None):
+    """Compresses one message, the compressor keeps the context between messages"""
+    if compressor is None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # The message ends with the 00 00 ff ff of the sync flush which is left out
+    return data[:-4]
+
+
+class PerMessageDeflate:
+    """Negotiated permessage-deflate state of a connection"""
+    def __init__(self, level, wbits, context_takeover, client_context_takeover):
+        self.level = level
+        self.wbits = wbits
+        self.context_takeover = context_takeover
+        self.client_context_takeover = client_context_takeover
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, payload):
+        if not self.context_takeover:
+            return deflate(payload, self.level, self.wbits)
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits)
+        return deflate(payload, self.level, self.wbits, self.compressor)
+
+    def decompress(self, payload, max_size):
+        decompressor = self.decompressor or zlib.decompressobj(-15)
+        try:
+            data = decompressor.decompress(payload + b'\x00\x00\xff\xff', max_size + 1)
+        except zlib.error as e:
+            raise ValueError('Failed to decompress message: {}'.format(e))
+        if len(data) > max_size or decompressor.unconsumed_tail:
+            raise MessageTooBig('Decompressed message too big')
+        # Without context takeover nothing is kept between messages of idle connections
+        self.decompressor = decompressor if self.client_context_takeover else None
+        return data
+
+
+class AsyncConnection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')[:2]
+        self.closed = False
+        self.deflate = None
+        # Compressing and queueing the write under one lock keeps the compression context in frame order
+        self.send_lock = threading.Lock()
+
+    async def handshake(self):
+        try:
+            request = await self.reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise HandshakeError('Incomplete handshake')
+
+        lines = request.decode('latin-1').split('\r\n')
+        if not lines[0].startswith('GET '):
+            raise HandshakeError('Not a GET request: {}'.format(lines[0]))
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+            raise HandshakeError('Not a websocket upgrade request')
+
+        self.headers = headers
+        accept = base64.b64encode(sha1((headers['sec-websocket-key'] + GUID).encode()).digest()).decode()
+        response = ['HTTP/1.1 101 Switching Protocols',
+                    'Upgrade: websocket',
+                    'Connection: Upgrade',
+                    'Sec-WebSocket-Accept: {}'.format(accept)]
+        if self.server.compression and 'sec-websocket-extensions' in headers:
+            self.deflate, extension = self.server.negotiate_deflate(headers['sec-websocket-extensions'])
+            if self.deflate is not None:
+                response.append('Sec-WebSocket-Extensions: {}'.format(extension))
+        self.writer.write(('\r\n'.join(response) + '\r\n\r\n').encode())
+        await self.writer.drain()
+
+    async def read_frame(self):
+        """Returns (fin, rsv1, opcode, payload)"""
+        header = await self.reader.readexactly(2)
+        fin = header[0] & 0x80
+        rsv1 = header[0] & 0x40
+        opcode = header[0] & 0x0F
+        masked = header[1] & 0x80
+        length = header[1] & 0x7F
+
+        if length == 126:
+            length, = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self.reader.readexactly(8))
+
+        if length > self.server.max_frame_size:
+            raise MessageTooBig('Frame too big ({} bytes)'.format(length))
+
+        if not masked:
+            raise ValueError('Received an unmasked frame')
+
+        mask = await self.reader.readexactly(4)
+        payload = await self.reader.readexactly(length)
+        if length:
+            # XOR over the whole payload at once instead of byte by byte
+            repeated = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+        return fin, rsv1, opcode, payload
+
+    async def read_message(self):
+        """Returns (opcode, payload) of the next data frame, control frames are handled here"""
+        fragments = []
+        size = 0
+        message_opcode = None
+        compressed = False
+        while True:
+            fin, rsv1, opcode, payload = await self.read_frame()
+
+            if rsv1 and (self.deflate is None or opcode >= OPCODE_CLOSE or opcode == OPCODE_CONTINUATION):
+                raise ValueError('Unexpected RSV1 bit on opcode {}'.format(opcode))
+
+            if opcode == OPCODE_PING:
+                self.write_frame(OPCODE_PONG, payload)
+                continue
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1000
+                self.close(code)
+                return None, None
+
+            if opcode != OPCODE_CONTINUATION:
+                message_opcode = opcode
+                compressed = bool(rsv1)
+            elif message_opcode is None:
+                raise ValueError('Continuation frame without a first frame')
+
+            # read_frame checks the frames one by one, the fragments of a message count together
+            size += len(payload)
+            if size > self.server.max_frame_size:
+                raise MessageTooBig('Message too big ({} bytes in {} fragments)'.format(size, len(fragments) + 1))
+            fragments.append(payload)
+            if fin:
+                payload = b''.join(fragments)
+                if compressed:
+                    payload = self.deflate.decompress(payload, self.server.max_frame_size)
+                return message_opcode, payload
+
+    def write_frame(self, opcode, payload, rsv1=False):
+        if self.closed and opcode != OPCODE_CLOSE:
+            return
+
+        length = len(payload)
+        first = 0x80 | (0x40 if rsv1 else 0) | opcode
+        if length < 126:
+            header = struct.pack('!BB', first, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', first, 126, length)
+        else:
+            header = struct.pack('!BBQ', first, 127, length)
+        self.writer.write(header + payload)
+
+    async def send(self, opcode, payload, rsv1=False):
+        self.write_frame(opcode, payload, rsv1)
+        await self.writer.drain()
+
+    def send_frame(self, opcode, payload, timeout=-1):
+        """Thread safe, blocks until the frame is handed to the socket or timeout runs out.
+        payload of data frames can be a str (text) and is compressed when negotiated"""
+        if self.closed:
+            return 0
+
+        with self.send_lock:
+            payload, rsv1 = self.prepare(payload)
+            future = asyncio.run_coroutine_threadsafe(self.send(opcode, payload, rsv1), self.server.loop)
+        future.result(None if timeout is None or timeout < 0 else timeout)
+        return len(payload)
+
+    def prepare(self, data):
+        """Returns (payload, rsv1) of a data frame"""
+        if self.deflate is None or len(data) < self.server.compression_threshold:
+            return (data.encode('utf-8') if type(data) == str else data), False
+
+        if not self.deflate.context_takeover:
+            return self.server.compress_shared(data, self.deflate.wbits), True
+        return self.deflate.compress(data.encode('utf-8') if type(data) == str else data), True
+
+    def send_text(self, text, timeout=-1):
+        return self.send_frame(OPCODE_TEXT, text, timeout)
+
+    def send_binary(self, data, timeout=-1):
+        return self.send_frame(OPCODE_BINARY, data, timeout)
+
+    def close(self, status_code=1000, reason=''):
+        if self.closed:
+            return
+        self.write_frame(OPCODE_CLOSE, struct.pack('!H', status_code) + reason.encode('utf-8')[:123])
+        self.closed = True
+        self.writer.close()
+
+
+class AsyncWebsocket:
+    """Drop in replacement for ewebsockets.Websocket running on an asyncio event loop"""
+    def __init__(self,
+                 handle_new_connection,
+                 handle_websocket_frame,
+                 on_client_open,
+                 on_client_close,
+                 host='',
+                 port=25565,
+                 max_workers=32,
+                 max_frame_size=1024*1024,
+                 backlog=1024,
+                 reuse_port=False,
+                 compression=False,
+                 compression_threshold=256,
+                 compression_level=6,
+                 context_takeover=False,
+                 client_context_takeover=False,
+                 compression_cache_size=64):
+        """With compression permessage-deflate is accepted when the client offers it. Messages
+        shorter than compression_threshold are sent uncompressed. context_takeover lets the
+        compression of a message use the earlier messages (better ratio, a compressor per
+        connection, no shared compression of broadcasts), client_context_takeover does the same
+        for the messages of the client"""
+        self.handle_new_connection = handle_new_connection
+        self.handle_websocket_frame = handle_websocket_frame
+        self.on_client_open = on_client_open
+        self.on_client_close = on_client_close
+        self.host = host
+        self.port = port
+        self.max_frame_size = max_frame_size
+        self.backlog = backlog
+        self.reuse_port = reuse_port  # Lets several processes listen on the same port
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.context_takeover = context_takeover
+        self.client_context_takeover = client_context_takeover
+        # {(wbits, payload): compressed}, the frames of a broadcast are the same str/bytes object
+        # for every member so the lookup hashes the payload only once
+        self.compression_cache = {}
+        self.compression_cache_size = compression_cache_size
+        self.compression_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ChatHandler')
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.server = None
+        self.connections = set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='AsyncWebsocket')
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(self.listen())
+            server_log.info('Listening on %s:%s', self.host, self.port)
+        finally:
+            self.started.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    async def listen(self):
+        return await asyncio.start_server(self.handle_connection, self.host or None, self.port,
+                                          backlog=self.backlog, reuse_port=self.reuse_port or None)
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    async def shutdown(self):
+        # Closing the open connections lets their handlers end normally and call on_client_close
+        self.server.close()
+        for connection in list(self.connections):
+            connection.close(1001)
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def negotiate_deflate(self, header):
+        """Returns (PerMessageDeflate, response extension) for the first acceptable
+        permessage-deflate offer in the Sec-WebSocket-Extensions header or (None, None)"""
+        for offer in header.split(','):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != 'permessage-deflate':
+                continue
+
+            options = {}
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                options[name.strip()] = value.strip().strip('"')
+            if not set(options) <= {'server_no_context_takeover', 'client_no_context_takeover',
+                                    'server_max_window_bits', 'client_max_window_bits'}:
+                continue
+
+            wbits = 15
+            if 'server_max_window_bits' in options:
+                try:
+                    wbits = int(options['server_max_window_bits'])
+                except ValueError:
+                    continue
+                # zlib can't compress with a window of 8 bits
+                if not 9 <= wbits <= 15:
+                    continue
+
+            context_takeover = self.context_takeover and 'server_no_context_takeover' not in options
+            client_context_takeover = self.client_context_takeover and 'client_no_context_takeover' not in options
+            response = ['permessage-deflate']
+            if not context_takeover:
+                response.append('server_no_context_takeover')
+            if not client_context_takeover:
+                response.append('client_no_context_takeover')
+            if 'server_max_window_bits' in options:
+                response.append('server_max_window_bits={}'.format(wbits))
+            return PerMessageDeflate(self.compression_level, wbits, context_takeover,
+                                     client_context_takeover), '; '.join(response)
+        return None, None
+
+    def compress_shared(self, data, wbits):
+        """Compresses a message without context, the result is the same for every connection"""
+        key = (wbits, data)
+        with self.compression_lock:
+            compressed = self.compression_cache.get(key)
+        if compressed is not None:
+            return compressed
+
+        compressed = deflate(data.encode('utf-8') if type(data) == str else data, self.compression_level, wbits)
+        with self.compression_lock:
+            if len(self.compression_cache) >= self.compression_cache_size:
+                del self.compression_cache[next(iter(self.compression_cache))]
+            self.compression_cache[key] = compressed
+        return compressed
+
+    async def call(self, function, *args):
+        return await self.loop.run_in_executor(self.executor, function, *args)
+
+    async def handle_connection(self, reader, writer):
+        connection = AsyncConnection(self, reader, writer)
+        try:
+            if not await self.call(self.handle_new_connection, connection):
+                writer.close()
+                return
+            await connection.handshake()
+        except (HandshakeError, ConnectionError) as e:
+            connection_log.debug('%s: Handshake failed: %s', connection.address, e)
+            writer.close()
+            return
+
+        self.connections.add(connection)
+        await self.call(self.on_client_open, connection)
+        try:
+            while not connection.closed:
+                opcode, payload = await connection.read_message()
+                if opcode is None:
+                    break
+                frame = Frame(opcodes.get(opcode, opcode), payload)
+                await self.call(self.handle_websocket_frame, connection, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except MessageTooBig as e:
+            connection_log.error('%s: %s', connection.address, e)
+            connection.close(1009)
+        except ValueError as e:
+            connection_log.error('%s: %s', connection.address, e)
+            connection.close(1002)
+        finally:
+            connection.closed = True
+            writer.close()
+            self.connections.discard(connection)
+            await self.call(self.on_client_close, connection)
+
+    def close_connection(self, connection, status_code=1000, reason=''):
+        """Thread safe"""
+        self.loop.call_soon_threadsafe(connection.close, status_code_value(status_code), reason)
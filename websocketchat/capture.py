@@ -0,0 +1,166 @@
+#!/bin/env python3
+"""Recording the requests a server gets so the traffic can be replayed, see benchmarks/replay.py
+
+    chat = Chat(capture_kwargs={'path': 'traffic.cap'})   # or chat.start_capture(path='traffic.cap')
+
+A capture file is MAGIC followed by records, each a 4 byte length and a MessagePack array
+[kind, t, connection, ...] where t is seconds since the recorder started:
+
+    ['h', 0, 0, wall_time, redacted_fields]                 header, starts every session
+    ['o', t, connection]                                    connection opened
+    ['r', t, connection, request_id, request_array, enc]    valid request, after decryption
+    ['s', t, connection, request_id, msg_id]                response handed to the client
+    ['c', t, connection]                                    connection closed
+
+The file is only appended to, every Recorder writes a new session to it. Connections are
+numbered per session, a connection that was open before the capture started is recorded as
+opened with its first request.
+
+The request fields named in redact are replaced with pseudonyms before they are written. The
+pseudonyms are a keyed hash of the value so the same email or password always gets the same
+pseudonym within a session (logins still match registrations on replay) while the key, random
+per session and never written, keeps them from being reversed.
+"""
+
+import os
+import hmac
+import struct
+import threading
+from hashlib import sha256
+from time import time, perf_counter
+from .forms import request_ids
+from .wire import pack, unpack
+
+MAGIC = b'WSCHATCAP1\n'
+
+# Message texts can be redacted too, they are replaced by as many x's so sizes stay the same
+redacted_fields = ('email', 'password', 'token', 'verification_code', 'name')
+
+
+class Recorder:
+    def __init__(self, path, redact=redacted_fields):
+        self.path = path
+        self.redact = tuple(redact)
+        self.key = os.urandom(32)
+        # {request_id: [(index in the request array, field), ...]}
+        self.redacted_indexes = {}
+        for request_id in request_ids:
+            indexes = [(i + 1, field) for i, field in enumerate(request_ids[request_id]['description'])
+                       if field in self.redact]
+            if indexes:
+                self.redacted_indexes[request_id] = indexes
+
+        self.lock = threading.Lock()
+        self.connections = {}  # {address: connection}
+        self.next_connection = 1
+        self.start = perf_counter()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.write(['h', 0, 0, time(), list(self.redact)])
+
+    def write(self, record):
+        data = pack(record)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(struct.pack('!I', len(data)) + data)
+
+    def connection(self, address):
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is not None:
+                return connection, False
+            connection = self.connections[address] = self.next_connection
+            self.next_connection += 1
+            return connection, True
+
+    def open(self, address):
+        connection, new = self.connection(address)
+        if new:
+            self.write(['o', perf_counter() - self.start, connection])
+
+    def request(self, address, request_id, request_array, enc):
+        t = perf_counter() - self.start
+        connection, new = self.connection(address)
+        if new:
+            self.write(['o', t, connection])
+        self.write(['r', t, connection, request_id, self.redact_request(request_id, request_array), int(enc)])
+
+    def response(self, address, request_id, msg_id):
+        t = perf_counter() - self.start
+        connection = self.connections.get(address)
+        if connection is not None:
+            self.write(['s', t, connection, request_id, msg_id])
+
+    def close(self, address):
+        t = perf_counter() - self.start
+        with self.lock:
+            connection = self.connections.pop(address, None)
+        if connection is not None:
+            self.write(['c', t, connection])
+
+    def redact_request(self, request_id, request_array):
+        """A copy of request_array with the redacted fields replaced, the request itself is still handled"""
+        if request_id == 'f':
+            return request_array[:1] + [request[:1] + self.redact_request(request[0], request[1:])
+                                        for request in request_array[1:]]
+        indexes = self.redacted_indexes.get(request_id)
+        if indexes is None:
+            return request_array
+
+        request_array = list(request_array)
+        for i, field in indexes:
+            request_array[i] = self.pseudonym(field, request_array[i])
+        return request_array
+
+    def pseudonym(self, field, value):
+        if field == 'text':
+            return 'x' * len(value)
+        if field in ('email', 'name'):
+            # The server doesn't tell them apart by case either
+            value = value.lower()
+        digest = hmac.new(self.key, value.encode('utf-8'), sha256).hexdigest()
+        if field == 'email':
+            return 'u{}@redacted.invalid'.format(digest[:16])
+        if field == 'name':
+            # Still a valid username, a letter and at most 14 more letters or digits
+            return 'U' + digest[:14]
+        return digest[:32]
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def stop(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path):
+    """Yields the records of a capture file, a record cut off at the end (the server was killed
+    while writing) ends it"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a capture file'.format(path))
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            length, = struct.unpack('!I', header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield unpack(data)
+
+
+def read_sessions(path):
+    """The records of every session in the capture file, [[record, ...], ...]"""
+    sessions = []
+    for record in read_capture(path):
+        if record[0] == 'h':
+            sessions.append([])
+        sessions[-1].append(record)
+    return sessions
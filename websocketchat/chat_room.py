@@ -1,34 +1,242 @@
 #!/bin/env python3
 
 from .forms import *
-import logging
+from . import crypto
+from .wire import encode_body, encode_frame
+from .log import room_log
 import json
+from time import perf_counter
+import threading
+from collections import deque
+
+def disconnect(clients):
+    for client in clients:
+        client.disconnect()
+
 
 class ChatRoom:
-    def __init__(self, name, room_id):
+    def __init__(self, name, room_id, history_size=100, group_key=False, pubsub=None, metrics=None, tracer=None):
         self.name = name
         self.room_id = room_id
-        self.clients = []
+        # Messages are published once per message to reach members connected to other nodes
+        self.pubsub = pubsub
+        # Used as an insertion ordered set, {client: None}
+        self.clients = {}
+
+        # With group_key the messages are encrypted once with a key shared by the room, with a
+        # new iv per message, the key is rotated whenever someone leaves
+        self.group_key = group_key
+        self.key = None
+        self.key_lock = threading.RLock()
+
+        # The latest messages of the room as (id, time, user, text), oldest first
+        self.history = deque(maxlen=history_size)
+        # Every message of the room with an id > history_floor is in self.history,
+        # None until the history has been seeded
+        self.history_floor = None
+        self.history_lock = threading.RLock()
+        self.history_hits = 0
+        self.history_misses = 0
+        # Encoded get_history results keyed by the id of their first message, {first_id: [count, json]}.
+        # Every last_id between two messages gets the same result so this is the bucket.
+        self.history_cache = {}
+        self.history_cache_size = 32
+
+        self.broadcast_seconds = None
+        self.tracer = tracer
+        if metrics is not None:
+            self.broadcast_seconds = metrics.histogram('chat_broadcast_seconds', 'Time to queue a broadcast for a room')
+            self.broadcast_frames = metrics.counter('chat_broadcast_frames_total', 'Frames queued by broadcasts')
+
+    def seed_history(self, messages, complete):
+        """messages are the latest messages of the room in chronological order, complete tells
+        if those are all messages of the room"""
+        if not self.history.maxlen:
+            return
+
+        with self.history_lock:
+            self.history.clear()
+            self.history_cache.clear()
+            self.history.extend(messages)
+            if complete:
+                self.history_floor = 0
+            elif len(self.history) > 0:
+                self.history_floor = self.history[0][0] - 1
+
+    def add_history(self, message):
+        with self.history_lock:
+            if self.history_floor is None:
+                return
+
+            if len(self.history) == self.history.maxlen:
+                self.history_floor = self.history[0][0]
+                if message[0] <= self.history_floor:
+                    return
+
+            # Messages are broadcast from several threads so they can arrive slightly out of order
+            i = len(self.history)
+            while i > 0 and self.history[i-1][0] > message[0]:
+                i -= 1
+            if i == len(self.history):
+                self.history.append(message)
+                self.extend_history_cache(message)
+            else:
+                if len(self.history) == self.history.maxlen:
+                    self.history.popleft()
+                    i -= 1
+                self.history.insert(i, message)
+                self.history_cache.clear()
+
+    def extend_history_cache(self, message):
+        # Appending the new message to the cached results instead of encoding them again,
+        # results that already are at the limit now start one message later and are dropped
+        encoded = None
+        first_id = self.history[0][0]
+        for key in list(self.history_cache):
+            count, text = self.history_cache[key]
+            if count >= self.history.maxlen or key < first_id:
+                del self.history_cache[key]
+                continue
+            if encoded is None:
+                encoded = json.JSONEncoder().encode(message)
+            self.history_cache[key] = [count + 1, EncodedJson(text[:-1] + ', ' + encoded + ']')]
+
+    def get_history(self, last_id, latest):
+        """Returns the latest messages with an id > last_id or None if they are not all in memory"""
+        with self.history_lock:
+            if self.history_floor is not None:
+                messages = []
+                for message in reversed(self.history):
+                    if message[0] <= last_id or len(messages) == latest:
+                        break
+                    messages.append(message)
+
+                if last_id >= self.history_floor or len(messages) == latest:
+                    self.history_hits += 1
+                    messages.reverse()
+                    return messages
+
+            self.history_misses += 1
+            return None
+
+    def get_history_encoded(self, last_id, latest):
+        """Same as get_history but returns the messages as an EncodedJson list"""
+        with self.history_lock:
+            messages = self.get_history(last_id, latest)
+            if messages is None:
+                return None
+            if len(messages) == 0:
+                return EncodedJson('[]')
+
+            key = messages[0][0]
+            cached = self.history_cache.get(key)
+            if cached is not None and cached[0] == len(messages):
+                return cached[1]
+
+            encoded = EncodedJson(json.JSONEncoder().encode(messages))
+            # add_history extends the cached results up to the size of the history
+            if latest == self.history.maxlen:
+                if len(self.history_cache) >= self.history_cache_size:
+                    del self.history_cache[next(iter(self.history_cache))]
+                self.history_cache[key] = [len(messages), encoded]
+            return encoded
+
+    # Frames are only queued while the key lock is held, so every member gets them in the
+    # order of the key changes, clients that have to be disconnected are collected in deferred
+    # and disconnected after the lock is let go (that takes other locks, see Client.send_frame)
 
     def add_client(self, client):
-        client.room_name = self.name
-        self.clients.append(client)
-        logging.debug('{}: {} entered room'.format(self.name, client.name))
+        deferred = []
+        with self.key_lock:
+            client.room_name = self.name
+            self.clients[client] = None
+            if self.group_key:
+                if self.key is None:
+                    self.key = crypto.generate_key_and_iv()[0]
+                self.send_key(client, deferred)
+        disconnect(deferred)
+        room_log.debug('%s: %s entered room', self.name, client.name)
 
     def remove_client(self, client):
+        deferred = []
         try:
-            client.room_name = None
-            self.clients.remove(client)
-            logging.debug('{}: {} exited room'.format(self.name, client.name))
-        except ValueError:
-            logging.debug('Failed to remove {} from {}'.format(client.name, self.name))
+            with self.key_lock:
+                client.room_name = None
+                del self.clients[client]
+                if self.group_key:
+                    self.rotate_key(deferred)
+            room_log.debug('%s: %s exited room', self.name, client.name)
+        except KeyError:
+            room_log.debug('Failed to remove %s from %s', client.name, self.name)
+        disconnect(deferred)
+
+    def send_key(self, client, deferred):
+        # The room key is wrapped in the key of the client
+        client.send(server_message_ids['room_key']['id'], [self.key.hex()], enc=True, deferred=deferred)
+
+    def rotate_key(self, deferred):
+        with self.key_lock:
+            if len(self.clients) == 0:
+                self.key = None
+                return
+
+            self.key = crypto.generate_key_and_iv()[0]
+            for client in list(self.clients):
+                self.send_key(client, deferred)
 
     def broadcast(self, type_id, message_array, encrypt=False):
-        logging.debug('{}: Broadcasting message: {}'.format(self.name, message_array))
-        for client in self.clients:
-            client.send(type_id, message_array, encrypt)
+        if self.broadcast_seconds is None and self.tracer is None:
+            return self.send_broadcast(type_id, message_array, encrypt)
+
+        start = perf_counter()
+        recipients = len(self.clients)
+        try:
+            return self.send_broadcast(type_id, message_array, encrypt)
+        finally:
+            end = perf_counter()
+            if self.broadcast_seconds is not None:
+                self.broadcast_seconds.observe(end - start)
+                self.broadcast_frames.inc(recipients)
+            if self.tracer is not None:
+                self.tracer.add('ChatRoom.broadcast', start, end)
 
-    def broadcast_message(self, msg_id, time, user, text):
+    def send_broadcast(self, type_id, message_array, encrypt=False):
+        room_log.debug('%s: Broadcasting message: %s', self.name, message_array)
+        # Encoding once per wire format for the whole room, only the encryption is done per client
+        bodies = {}
+        frames = {}
+
+        def body(format):
+            if format not in bodies:
+                bodies[format] = encode_body(format, type_id, message_array)
+            return bodies[format]
+
+        def shared_frame(format, prefix, key=None):
+            if format not in frames:
+                frames[format] = encode_frame(format, body(format), prefix, key)
+            return frames[format]
+
+        if not encrypt:
+            for client in list(self.clients):
+                client.send_frame(shared_frame(client.format, '0'), droppable=True)
+            return
+
+        if self.group_key:
+            # Holding the key lock so no member gets a frame encrypted with a key it doesn't have yet
+            deferred = []
+            with self.key_lock:
+                if self.key is None:
+                    return
+                for client in list(self.clients):
+                    client.send_frame(shared_frame(client.format, '2', self.key), droppable=True, deferred=deferred)
+            disconnect(deferred)
+            return
+
+        for client in list(self.clients):
+            client.send_frame(encode_frame(client.format, body(client.format), '1', client.key, client.iv),
+                              droppable=True)
+
+    def broadcast_message(self, msg_id, time, user, text, publish=True):
         # self.broadcast({
         #     'type': server_forms['SINGLE_MESSAGE'],
         #     'user': user,
@@ -36,7 +244,12 @@ class ChatRoom:
         #     'time': time,
         #     'id': msg_id
         # })
+        self.add_history((msg_id, time, user, text))
         self.broadcast(
             type_id=server_message_ids['single_message']['id'],
-            message_array=[msg_id, time, user, text])
+            message_array=[msg_id, time, user, text],
+            encrypt=self.group_key)
+
+        if publish and self.pubsub is not None:
+            self.pubsub.publish(self.name, [msg_id, time, user, text])
 
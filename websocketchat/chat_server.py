@@ -2,19 +2,30 @@
 
 import ewebsockets
 from ewebsockets import Frame, OpCode
-from time import time, sleep
-import maxthreads
+from time import time, sleep, perf_counter
 from .forms import *
-import logging
+from .log import server_log, connection_log, request_log, room_log, protocol_log
 from .chat_room import *
 from .database import *
 from .client import Client
+from .registry import Registry
+from .deadlines import DeadlineWatcher
+from .metrics import Metrics, MetricsServer
+from .capture import Recorder
+from .profiling import Tracer, Sampler
+from .async_server import AsyncWebsocket
 from .crypto import *
+from .wire import unpack
 import random, string
 from .email_functions import *
 import pdb
-import validators
 import re
+import json
+import os
+import signal
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 def str2hex(string):
     try:
@@ -43,94 +54,391 @@ def random_str(n):
 class Chat:
     def __init__(self,
                  max_send_threads=10,
-                 send_timeout=2):
-
-        self.server = ewebsockets.Websocket(
-            handle_new_connection=self.handle_new_connection,
-            handle_websocket_frame=self.handle_incoming_frame,
-            on_client_open=self.on_client_open,
-            on_client_close=self.on_client_close,
-            esockets_kwargs={
-                'port': 25565,
-                # 'host': '192.168.1.3'
-            }
-        )
-        self.rooms = {}
-        self.db = ChatDb()
-        self.send_threads_limiter = maxthreads.MaxThreads(max_send_threads)
+                 send_timeout=2,
+                 history_size=100,
+                 room_group_keys=False,
+                 max_queued_messages=1000,
+                 max_queued_bytes=4*1024*1024,
+                 overflow_policy='drop_oldest',
+                 engine='ewebsockets',
+                 host='',
+                 port=25565,
+                 handler_threads=32,
+                 reuse_port=False,
+                 pubsub=None,
+                 db_threads=8,
+                 db_kwargs=None,
+                 compression_kwargs=None,
+                 request_timeout=10,
+                 metrics=None,
+                 metrics_port=None,
+                 capture_kwargs=None,
+                 tracer=None,
+                 profile_signal=signal.SIGUSR1,
+                 profile_dir=None):
+        """engine is 'ewebsockets' (a thread per connection) or 'asyncio' (connections on one event
+        loop, handlers in a pool of handler_threads threads)
+
+        reuse_port (asyncio engine only) is used when running several processes, see Supervisor.
+        pubsub connects rooms with the same name on other processes or machines, see pubsub.py
+
+        Requests are handled by a pool of db_threads threads so the thread reading the frames is
+        never held up by the database, db_threads=0 handles them on the reading thread
+
+        db_kwargs are passed on to ChatDb, e.g. {'write_behind': True, 'write_durability': 'enqueue'}
+        or the connection pragmas {'synchronous': 'NORMAL', 'mmap_size': 268435456, 'cache_size': -16000}
+
+        compression_kwargs (asyncio engine only) turns on permessage-deflate, {} for the defaults or
+        e.g. {'compression_threshold': 512, 'context_takeover': False}, see AsyncWebsocket
+
+        A request not answered within request_timeout seconds gets a request_timeout server message
+        instead of its response, None waits forever
+
+        Request, frame, database and broadcast latencies are recorded in metrics (a new
+        metrics.Metrics if None), metrics_port serves them on http://127.0.0.1:metrics_port/metrics
+
+        capture_kwargs records the requests for replaying them later, e.g. {'path': 'traffic.cap'}
+        or {'path': 'traffic.cap', 'redact': ()} to keep emails and passwords, see capture.py
+
+        Frames, decryption, validation, request handlers, database calls and broadcasts are trace
+        spans in tracer (a disabled profiling.Tracer if None). profile_signal toggles the sampling
+        profiler and the spans, stopping writes the collapsed stacks and the trace to profile_dir
+        (the temp dir if None). With metrics_port the same is served on demand, /profile?seconds=10
+        for the collapsed stacks and /trace?seconds=10 for the trace"""
+
+        if engine == 'ewebsockets':
+            if reuse_port:
+                raise ValueError('reuse_port requires the asyncio engine')
+            if compression_kwargs is not None:
+                # ewebsockets does the handshake itself so the extension can't be negotiated
+                raise ValueError('compression requires the asyncio engine')
+            self.server = ewebsockets.Websocket(
+                handle_new_connection=self.handle_new_connection,
+                handle_websocket_frame=self.handle_incoming_frame,
+                on_client_open=self.on_client_open,
+                on_client_close=self.on_client_close,
+                esockets_kwargs={
+                    'port': port,
+                    # 'host': '192.168.1.3'
+                }
+            )
+        elif engine == 'asyncio':
+            self.server = AsyncWebsocket(
+                handle_new_connection=self.handle_new_connection,
+                handle_websocket_frame=self.handle_incoming_frame,
+                on_client_open=self.on_client_open,
+                on_client_close=self.on_client_close,
+                host=host,
+                port=port,
+                max_workers=handler_threads,
+                reuse_port=reuse_port,
+                compression=compression_kwargs is not None,
+                **(compression_kwargs or {})
+            )
+        else:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        self.rooms = Registry()
+        self.pubsub = pubsub
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.sampler = Sampler()
+        self.profile_signal = profile_signal
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.profile_tracing = False
+        self.db = ChatDb(metrics=self.metrics, tracer=self.tracer, **(db_kwargs or {}))
+        self.db_executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='ChatDb') \
+            if db_threads > 0 else None
+        self.request_timeout = request_timeout
+        self.recorder = None
+        if capture_kwargs is not None:
+            self.start_capture(**capture_kwargs)
+        self.deadlines = DeadlineWatcher() if request_timeout is not None else None
+        if self.deadlines is not None:
+            self.deadlines.start()
+        self.stage_lock = threading.Lock()
+        self.protocol_depth = 0
+        self.db_queued = 0
+        self.db_running = 0
+        self.send_executor = ThreadPoolExecutor(max_workers=max_send_threads, thread_name_prefix='ChatSend')
         self.send_timeout = send_timeout
-        self.clients = {}
+        # Per client outbound queue limits, see Client
+        self.max_queued_messages = max_queued_messages
+        self.max_queued_bytes = max_queued_bytes
+        self.overflow_policy = overflow_policy
+        self.clients = Registry()
         self.latency = 0  # Simulated latency on all requests and connects REMOVE THIS
+        self.history_size = history_size  # Messages sent on enter_room and kept in memory per room
+        self.room_group_keys = room_group_keys  # Encrypt room messages once with a shared room key
         self.request_handlers = {}
 
         # Loading request handlers dict with the handler functions
         for request_id in request_ids:
             self.request_handlers[request_id] = getattr(self, 'handle_request_'+request_ids[request_id]['type'])
 
+        self.request_seconds = {}
+        self.request_errors = {}
+        self.request_spans = {}
+        for request_id in request_ids:
+            request_type = request_ids[request_id]['type']
+            self.request_spans[request_id] = 'handle_request_' + request_type
+            self.request_seconds[request_id] = self.metrics.histogram(
+                'chat_request_seconds', 'Time to handle a request', request=request_type)
+            self.request_errors[request_id] = self.metrics.counter(
+                'chat_request_errors_total', 'Requests that raised an exception', request=request_type)
+        self.request_timeouts = self.metrics.counter('chat_request_timeouts_total', 'Requests answered with a timeout')
+        self.frame_seconds = self.metrics.histogram('chat_frame_seconds', 'Time to decrypt, decode and validate a frame')
+        self.invalid_frames = self.metrics.counter('chat_invalid_frames_total', 'Frames that were not a valid request')
+        self.metrics.gauge('chat_connected_clients', 'Connected clients', function=lambda: len(self.clients))
+        self.metrics.gauge('chat_loaded_rooms', 'Rooms in memory', function=lambda: len(self.rooms))
+        self.metrics.gauge('chat_outbound_queue_depth', 'Frames queued for sending to all clients',
+                           function=lambda: sum(client.queue_depth() for client in self.clients.values()))
+        for stage in ('protocol', 'db_queued', 'db_running', 'outbound'):
+            self.metrics.gauge('chat_stage_depth', 'Requests in each stage, frames for outbound',
+                               function=lambda stage=stage: self.stage_depths()[stage], stage=stage)
+
     def start(self):
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, port=self.metrics_port,
+                                                routes={'/profile': self.profile_route, '/trace': self.trace_route})
+            self.metrics_server.start()
+        # Signal handlers can only be set from the main thread
+        if self.profile_signal is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(self.profile_signal, self.toggle_profiling)
+        if self.pubsub is not None:
+            self.pubsub.start(self.handle_pubsub_message)
         self.server.start()
 
     def stop(self):
         self.server.stop()
+        # Closed clients stop flushing so the send threads can finish
+        for client in self.clients.values():
+            client.close()
+        self.send_executor.shutdown(wait=True)
+        if self.db_executor is not None:
+            self.db_executor.shutdown(wait=True)
+        if self.deadlines is not None:
+            self.deadlines.stop()
+        if self.pubsub is not None:
+            self.pubsub.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.stop_capture()
+        self.sampler.stop()
+        self.db.close()
+
+    def start_capture(self, **capture_kwargs):
+        """Starts recording requests, can be called on a running server"""
+        self.stop_capture()
+        self.recorder = Recorder(**capture_kwargs)
+        server_log.info('Capturing requests to %s', self.recorder.path)
+
+    def stop_capture(self):
+        recorder = self.recorder
+        if recorder is not None:
+            self.recorder = None
+            recorder.stop()
+
+    def toggle_profiling(self, *args):
+        """Starts the sampler and the trace spans, or stops them and writes the results to profile_dir"""
+        if not self.sampler.running:
+            self.profile_tracing = self.tracer.enabled
+            self.tracer.clear()
+            self.tracer.enabled = True
+            self.sampler.start()
+            server_log.info('Profiling started')
+            return
+
+        self.sampler.stop()
+        self.tracer.enabled = self.profile_tracing
+        name = os.path.join(self.profile_dir, 'chat-{}-{}'.format(os.getpid(), int(time())))
+        self.sampler.dump(name + '.collapsed')
+        self.tracer.dump(name + '.trace.json')
+        server_log.info('Profiling stopped, wrote %s.collapsed and %s.trace.json', name, name)
+
+    def profile_seconds(self, query):
+        seconds = float(query.get('seconds', ['10'])[0])
+        if not 0 < seconds <= 300:
+            raise ValueError('seconds has to be between 0 and 300')
+        return seconds
+
+    def profile_route(self, query):
+        # A sampler of its own so it doesn't get in the way of the one toggled by the signal
+        seconds = self.profile_seconds(query)
+        sampler = Sampler()
+        sampler.start()
+        sleep(seconds)
+        sampler.stop()
+        return 'text/plain; charset=utf-8', sampler.collapsed()
+
+    def trace_route(self, query):
+        seconds = self.profile_seconds(query)
+        enabled = self.tracer.enabled
+        self.tracer.enabled = True
+        start = perf_counter()
+        sleep(seconds)
+        self.tracer.enabled = enabled
+        trace = self.tracer.trace()
+        # Only the spans that started while waiting
+        trace['traceEvents'] = [event for event in trace['traceEvents']
+                                if event['ph'] == 'M' or event['ts'] >= start * 1e6]
+        return 'application/json', json.dumps(trace)
+
+    def handle_pubsub_message(self, room_name, message_array):
+        # A message sent to a room on another node, the room can have been removed since
+        room = self.rooms.get(room_name)
+        if room is not None:
+            room.broadcast_message(*message_array, publish=False)
+
+    def handle_request(self, client, request_id, request_array, deadline=None):
+        # Expired while queued, the client was told it won't be handled so it mustn't change anything
+        if deadline is not None and self.deadlines.expired(deadline):
+            request_log.warning('%s: Request %s expired before it was handled', client, request_id)
+            return False
+
+        start = perf_counter()
+        try:
+            response = self.run_handler(client, request_id, request_array)
+        except Exception:
+            self.request_errors[request_id].inc()
+            # Failed requests get no request_timeout either
+            if deadline is not None:
+                self.deadlines.finish(deadline)
+            raise
+        finally:
+            self.request_seconds[request_id].observe(perf_counter() - start)
+
+        # The client already got a request_timeout if the deadline expired
+        if deadline is not None and not self.deadlines.finish(deadline):
+            request_log.warning('%s: Request %s finished after its deadline', client, request_id)
+            return False
 
-    def handle_request(self, client, request_id, request_array):
+        if response is None:
+            return False
+
+        response_array, enc = response
+        client.send(request_id, response_array, enc)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.response(client.websocket.address, request_id, request_array[0])
+        return True
+
+    def run_handler(self, client, request_id, request_array):
+        """Returns ([msg_id] + response_array, enc) or None if the request has no response"""
         msg_id = request_array[0]
 
         # kwargs = {'client':client}
         # for i in range(1, len(request_array)):
         #     kwargs[request_ids[request_id]['description'][i-1]] = request_array[i]
-        response = self.request_handlers[request_id](client, *request_array[1:])
+        with self.tracer.span(self.request_spans[request_id]):
+            response = self.request_handlers[request_id](client, *request_array[1:])
         # print('KWARGS!')
         # print(kwargs)
         if response is None:
-            return False
+            return
 
         response_array, enc = response
-
-        response_array = [msg_id] + response_array
-
-        # client.send(request_id, response_array, enc)
-        return True
+        return [msg_id] + response_array, enc
+
+    def handle_request_batch(self, client, *requests):
+        # The sub-requests were validated together, they are handled in order as separate frames would be
+        responses = []
+        enc = 0
+        for request in requests:
+            request_id, request_array = request[0], request[1:]
+            try:
+                response = self.run_handler(client, request_id, request_array)
+            except Exception as e:
+                request_log.exception('%s: Request %s in batch failed: %s', client, request_id, e)
+                continue
+            if response is None:
+                continue
+
+            response_array, sub_enc = response
+            responses.append([request_id] + response_array)
+            # Encrypting the whole response if any part of it needs it
+            enc = enc or sub_enc
+        return [responses], enc
 
     def handle_request_enter_room(self, client, room_name, last_id):
+        if client.closed:
+            return
         room_name = room_name.lower()
-        if room_name not in self.rooms:
-            self.load_room(room_name)
-        messages = self.db.get_messages(room_name, last_id, latest=100)
-
         if client.room_name is not None:
-            self.rooms[client.room_name].remove_client(client)
+            self.leave_room(client)
+
+        # The room is loaded without the room lock, joining is done under it so the room can't be
+        # removed by the last member leaving meanwhile. If that happened before the lock was taken
+        # the room is looked up (loaded) again.
+        while True:
+            room = self.rooms.get_or_create(room_name, self.load_room)
+            with self.rooms.lock(room_name):
+                if self.rooms.get(room_name) is room:
+                    room.add_client(client)
+                    break
+
+        # Closed while joining, on_client_close can have looked for the room before it was joined
+        if client.closed:
+            self.leave_room(client)
+            return
+
+        # Served as pre-encoded JSON straight from the room when possible
+        messages = room.get_history_encoded(last_id, self.history_size)
+        if messages is None:
+            messages = self.db.get_messages(room_name, last_id, latest=self.history_size)
+
+        # With room keys the messages are encrypted, so is the history (with the key of the client)
+        return [messages], int(self.room_group_keys)
+
+    def leave_room(self, client):
+        room_name = client.room_name
+        with self.rooms.lock(room_name):
+            room = self.rooms.get(room_name)
+            if room is None:
+                return
 
-        client.room_name = room_name
-        self.rooms[room_name].add_client(client)
+            room.remove_client(client)
+            if len(room.clients) == 0:
+                del self.rooms[room_name]
+                if self.pubsub is not None:
+                    self.pubsub.unsubscribe(room_name)
+                room_log.debug('Removing room "%s" from memory because no users are left in it', room_name)
+
+    def handle_request_set_format(self, client, format):
+        # Takes effect right away, the response already comes in the new format
+        if format not in client.available_formats:
+            return [0], 0
 
-        return [messages], 0
+        client.format = format
+        request_log.debug('%s: Switched to the %s format', client, format)
+        return [1], 0
 
     def handle_request_get_token(self, client):
         if client.logged_in:
             token = self.db.new_token(client)
         else:
-            logging.error('{}: Tried to get token w/o being logged in'.format(client.address()))
+            request_log.error('%s: Tried to get token w/o being logged in', client)
             return
         return [token], 1
 
     def handle_request_send_message(self, client, text):
         if not client.logged_in:
-            logging.error('{}: Client tried to send a message w/o being logged in'.format(client.address()))
+            request_log.error('%s: Client tried to send a message w/o being logged in', client)
             return
 
         if client.room_name is None:
-            logging.error('{}: Client tried to send a message w/o first entering a room'.format(client.address()))
+            request_log.error('%s: Client tried to send a message w/o first entering a room', client)
             return
 
-        if client.room_name not in self.rooms:
-            logging.error('{}: Client tried to send a message to a non-existent room: {} '.format(
-                client.address(), client.room_name
-            ))
+        room = self.rooms.get(client.room_name)
+        if room is None:
+            request_log.error('%s: Client tried to send a message to a non-existent room: %s ',
+                              client, client.room_name)
             return
 
         message_id, _time = self.db.add_message(client, text)
-        self.rooms[client.room_name].broadcast_message(message_id, _time, client.name, text)
+        room.broadcast_message(message_id, _time, client.name, text)
         return [], 0
 
     def handle_request_check_username(self, client, name):
@@ -155,28 +463,25 @@ class Chat:
             client.email = email
             if not request_email_verification:
                 client.logged_in = True
-                logging.info('{} logged in'.format(client.address()))
+                request_log.info('%s logged in', client)
             else:
-                logging.info('{} Login success, but requested email verification'.format(client.address()))
+                request_log.info('%s Login success, but requested email verification', client)
 
         else:
             accepted = 0
-            logging.info('{} login failed'.format(client.address()))
-        print('TOKEN: ', token, type(token), len(token), int(token != ''))
+            request_log.info('%s login failed', client)
         return [accepted, int(request_email_verification), client.name, token], int(token != '')
 
     def handle_request_logout(self, client, token):
         if not client.logged_in:
-            logging.error('{}: Client tried to logout w/o being logged in'.format(client.address()))
+            request_log.error('%s: Client tried to logout w/o being logged in', client)
             return
 
         if token != '':
             self.db.remove_token(client, token)
-            logging.debug('{}: Client logout removed unused token ({})'.format(
-                    client.address(), token
-            ))
+            request_log.debug('%s: Client logout removed unused token (%s)', client, token)
 
-        logging.debug('{}: logged out'.format(client.address()))
+        request_log.debug('%s: logged out', client)
         client.logout()
         return [], 0
 
@@ -189,20 +494,14 @@ class Chat:
             client.email = email
             if not request_email_verification:
                 client.logged_in = True
-                logging.info('{} logged in with token: {}'.format(
-                    client.address(), token
-                ))
+                request_log.info('%s logged in with token: %s', client, token)
             else:
-                logging.info('{} logged in with token, but email verification requested: {}'.format(
-                    client.address(), token
-                ))
+                request_log.info('%s logged in with token, but email verification requested: %s', client, token)
 
         else:
             accepted = 0
             request_email_verification = False
-            logging.info('{} auto login failed with token {}'.format(
-                client.address(), token
-            ))
+            request_log.info('%s auto login failed with token %s', client, token)
 
         return [accepted, int(request_email_verification), client.name, new_token], int(new_token != '')
 
@@ -214,9 +513,8 @@ class Chat:
 
         if not name_available or not email_available:
             accepted = 0
-            logging.debug('{}: Tried to register but name({}) or email({}) unavailable'.format(
-                client.address(), not name_available, not email_available
-            ))
+            request_log.debug('%s: Tried to register but name(%s) or email(%s) unavailable',
+                              client, not name_available, not email_available)
         else:
             accepted = 1
             client.id, client.verification_code = self.db.new_user(email, name, password)
@@ -229,23 +527,23 @@ class Chat:
 
     def handle_request_verify_email(self, client, verification_code):
         if client.email is None:
-            logging.error('{}: Tried to verify email w/o email set'.format(client.address()))
+            request_log.error('%s: Tried to verify email w/o email set', client)
             return
 
         if client.verification_code is None:
             client.verification_code = self.db.get_verification_code(client.id)
 
         if client.verification_code is None:
-            logging.error('{}: Tried to verify an already verified email'.format(client.address()))
+            request_log.error('%s: Tried to verify an already verified email', client)
             return
 
         if verification_code == client.verification_code:
-            logging.debug('{}: Email verification success!'.format(client.address()))
+            request_log.debug('%s: Email verification success!', client)
             self.db.remove_verification_code(client.id)
             accepted = 1
         else:
-            logging.debug('{}: Email verification failed expected {} but got {}'.format(
-                client.address(), client.verification_code, verification_code))
+            request_log.debug('%s: Email verification failed expected %s but got %s',
+                              client, client.verification_code, verification_code)
             accepted = 0
 
         if accepted:
@@ -255,12 +553,12 @@ class Chat:
 
     def handle_request_new_verification_code(self, client):
         if client.email is None:
-            logging.error('{}: Tried to get new verification code w/o email set'.format(client.address()))
+            request_log.error('%s: Tried to get new verification code w/o email set', client)
             return
 
         new_verification_code = self.db.get_new_verification_code(client.id)
         if new_verification_code is None:
-            logging.error('{}: Tried to get new verification code but email is already verified'.format(client.address()))
+            request_log.error('%s: Tried to get new verification code but email is already verified', client)
             return
 
         client.verification_code = new_verification_code
@@ -762,64 +1060,222 @@ class Chat:
                 'name': name,
                 'created': time()
             })
-            logging.debug('Room "{}" created'.format(name))
+            room_log.debug('Room "%s" created', name)
         else:
             room_id = data[0]
-        self.rooms[name] = ChatRoom(name, room_id)
-        logging.debug('Room "{}" loaded'.format(name))
+        room = ChatRoom(name, room_id, history_size=self.history_size, group_key=self.room_group_keys,
+                        pubsub=self.pubsub, metrics=self.metrics, tracer=self.tracer)
+        if self.pubsub is not None:
+            self.pubsub.subscribe(name)
+        messages = self.db.get_messages(name, 0, latest=self.history_size)
+        room.seed_history(messages, complete=len(messages) < self.history_size)
+        room_log.debug('Room "%s" loaded', name)
+        return room
 
     def handle_incoming_frame(self, client, frame):
         sleep(self.latency)
-        if frame.opcode == OpCode.TEXT:
-            client_obj = self.clients[client.address]
-            # logging.debug('Payload: {}'.format(frame.payload))
-            if len(frame.payload) < 1:
-                logging.debug('{}: Received a text frame that contained less that 1 bytes: {}'.format(frame.payload))
-                return False
+        if frame.opcode == OpCode.TEXT or frame.opcode == OpCode.BINARY:
+            with self.tracer.span('handle_incoming_frame'):
+                return self.handle_data_frame(client, frame)
+        else:
+            # logging.debug('Received a frame containing unaccepted opcode: {}'.format(frame.opcode))
+            return True
+
+    def handle_data_frame(self, client, frame):
+        """A text or binary frame, read and handed to the db stage"""
+        client_obj = self.clients[client.address]
+        with self.stage_lock:
+            self.protocol_depth += 1
+        start = perf_counter()
+        try:
+            request = self.read_request(client_obj, frame)
+        finally:
+            self.frame_seconds.observe(perf_counter() - start)
+            with self.stage_lock:
+                self.protocol_depth -= 1
+
+        if request is None:
+            self.invalid_frames.inc()
+            return False
+
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.request(client.address, request[0], request[1], frame.payload[0] != b'0'[0])
+        self.submit_request(client_obj, *request)
+        return True
+
+    def read_request(self, client_obj, frame):
+        """Protocol stage, decrypts and validates a frame. Returns (request_id, request_array)
+        or None if the frame is not a valid request"""
+        if frame.opcode == OpCode.BINARY:
+            return self.read_binary_request(client_obj, frame)
+
+        # logging.debug('Payload: {}'.format(frame.payload))
+        if len(frame.payload) < 1:
+            protocol_log.debug('%s: Received a text frame that contained less that 1 bytes: %s',
+                               client_obj, frame.payload)
+            return
+        try:
+            msg = frame.payload[1:].decode('utf-8')
+        except UnicodeDecodeError as e:
+            protocol_log.error('%s: Failed to convert payload %s', client_obj, e)
+            return
+
+        if frame.payload[0] == b'0'[0]:
+            pass
+        elif frame.payload[0] == b'1'[0] and type(client_obj.key) == bytes and type(client_obj.iv) == bytes:
+            # Received a frame containing encrypted data
+            if not validate_hexstring(msg):
+                protocol_log.error('%s: Encrypted message is not a valid hex string: %s', client_obj, msg)
+                return
             try:
-                msg = frame.payload[1:].decode('utf-8')
-            except UnicodeDecodeError as e:
-                logging.error('{}: Failed to convert payload {}'.format(client_obj.address(), e))
-                return False
-
-            if frame.payload[0] == b'0'[0]:
-                pass
-            elif frame.payload[0] == b'1'[0] and type(client_obj.key) == bytes and type(client_obj.iv) == bytes:
-                # Received a frame containing encrypted data
-                if not validate_hexstring(msg):
-                    logging.error('{}: Encrypted message is not a valid hex string: {}'.format(
-                        client_obj.address(), msg
-                    ))
-                    return False
-                try:
+                with self.tracer.span('decrypt'):
                     msg = decrypt(str2hex(msg), client_obj.key, client_obj.iv).decode('utf-8')
-                except ValueError as e:
-                    logging.error('{}: Failed to decrypt data: {}'.format(
-                        client_obj.address(), e
-                    ))
-                    return False
-
+            except ValueError as e:
+                protocol_log.error('%s: Failed to decrypt data: %s', client_obj, e)
+                return
 
-            elif frame.payload[0] == b'1'[0] and (type(client_obj.key) != bytes or type(client_obj.iv) != bytes):
-                logging.debug('Received an encrypted text frame w/o the client key or iv set')
-                return False
-            else:
-                logging.error('{}: Received a text frame where the first byte (encrypted byte)'
-                              ' was not 1 or 0'.format(client_obj.address()))
-                return False
+        elif frame.payload[0] == b'1'[0] and (type(client_obj.key) != bytes or type(client_obj.iv) != bytes):
+            protocol_log.debug('Received an encrypted text frame w/o the client key or iv set')
+            return
+        else:
+            protocol_log.error('%s: Received a text frame where the first byte (encrypted byte)'
+                               ' was not 1 or 0', client_obj)
+            return
 
+        with self.tracer.span('validate_request'):
             is_valid_request, validate_info = validate_request(msg)
-            if not is_valid_request:
-                logging.error('{}: {}'.format(client_obj.address(), validate_info))
-                return False
+        if not is_valid_request:
+            protocol_log.error('%s: %s', client_obj, validate_info)
+            return
 
-            return self.handle_request(client_obj, validate_info[0], validate_info[1])
+        return validate_info[0], validate_info[1]
+
+    def read_binary_request(self, client_obj, frame):
+        """Same as read_request for the binary frames of the msgpack format"""
+        if client_obj.format != 'msgpack':
+            protocol_log.error('%s: Received a binary frame w/o switching to the msgpack format', client_obj)
+            return
 
-            # return self.handle_request(client_obj, msg)
+        payload = frame.payload
+        if len(payload) < 2:
+            protocol_log.debug('%s: Received a binary frame that contained less than 2 bytes', client_obj)
+            return
+
+        if payload[0] == b'0'[0]:
+            body = payload[1:]
+        elif payload[0] == b'1'[0] and type(client_obj.key) == bytes and type(client_obj.iv) == bytes:
+            if (len(payload) - 1) % 16 != 0:
+                protocol_log.error('%s: Encrypted binary frame has an invalid length: %s',
+                                   client_obj, len(payload) - 1)
+                return
+            try:
+                with self.tracer.span('decrypt'):
+                    body = decrypt(bytes(payload[1:]), client_obj.key, client_obj.iv)
+            except ValueError as e:
+                protocol_log.error('%s: Failed to decrypt data: %s', client_obj, e)
+                return
+            if len(body) < 2:
+                protocol_log.error('%s: Encrypted binary frame is too short', client_obj)
+                return
+        elif payload[0] == b'1'[0]:
+            protocol_log.debug('Received an encrypted binary frame w/o the client key or iv set')
+            return
         else:
-            # logging.debug('Received a frame containing unaccepted opcode: {}'.format(frame.opcode))
+            protocol_log.error('%s: Received a binary frame where the first byte (encrypted byte)'
+                               ' was not 1 or 0', client_obj)
+            return
+
+        try:
+            request_array = unpack(body[1:])
+        except ValueError as e:
+            protocol_log.error('%s: %s', client_obj, e)
+            return
+
+        with self.tracer.span('validate_request'):
+            is_valid_request, validate_info = validate_request_array(chr(body[0]), request_array)
+        if not is_valid_request:
+            protocol_log.error('%s: %s', client_obj, validate_info)
+            return
+
+        return validate_info[0], validate_info[1]
+
+    def submit_request(self, client, request_id, request_array):
+        """Hands a validated request to the db stage. Ordered requests of one client are handled
+        one at a time and in order, the other requests in parallel"""
+        deadline = None
+        if self.deadlines is not None:
+            msg_id = request_array[0]
+            deadline = self.deadlines.add(self.request_timeout,
+                                          lambda: self.handle_request_timeout(client, request_id, msg_id))
+
+        if self.db_executor is None:
+            return self.handle_request(client, request_id, request_array, deadline)
+
+        with self.stage_lock:
+            self.db_queued += 1
+        if not request_ids[request_id]['ordered']:
+            self.db_executor.submit(self.execute_request, client, request_id, request_array, deadline)
             return True
 
+        with client.requests_lock:
+            client.pending_requests.append((request_id, request_array, deadline))
+            start = not client.handling_requests
+            client.handling_requests = True
+
+        if start:
+            self.db_executor.submit(self.run_request, client)
+        return True
+
+    def run_request(self, client):
+        with client.requests_lock:
+            # Emptied by on_client_close
+            if len(client.pending_requests) == 0:
+                client.handling_requests = False
+                return
+            request_id, request_array, deadline = client.pending_requests.popleft()
+
+        self.execute_request(client, request_id, request_array, deadline)
+
+        # Resubmitting instead of looping so a busy client doesn't hold on to a worker
+        with client.requests_lock:
+            if len(client.pending_requests) == 0:
+                client.handling_requests = False
+                return
+        self.db_executor.submit(self.run_request, client)
+
+    def execute_request(self, client, request_id, request_array, deadline):
+        if client.closed:
+            with self.stage_lock:
+                self.db_queued -= 1
+            if deadline is not None:
+                self.deadlines.finish(deadline)
+            return
+
+        with self.stage_lock:
+            self.db_queued -= 1
+            self.db_running += 1
+        try:
+            self.handle_request(client, request_id, request_array, deadline)
+        except Exception as e:
+            request_log.exception('%s: Request %s failed: %s', client, request_id, e)
+        finally:
+            with self.stage_lock:
+                self.db_running -= 1
+
+    def handle_request_timeout(self, client, request_id, msg_id):
+        self.request_timeouts.inc()
+        request_log.warning('%s: Request %s (%s) timed out', client, request_id, msg_id)
+        client.send(server_message_ids['request_timeout']['id'], [msg_id, request_id])
+
+    def stage_depths(self):
+        """Requests in each stage right now, for capacity planning"""
+        with self.stage_lock:
+            depths = {'protocol': self.protocol_depth,
+                      'db_queued': self.db_queued,
+                      'db_running': self.db_running}
+        depths['outbound'] = sum(client.queue_depth() for client in self.clients.values())
+        return depths
 
     def handle_new_connection(self, client):
         return True
@@ -828,25 +1284,45 @@ class Chat:
         sleep(self.latency)
         new_client = Client(
             websocket=client,
-            send_limiter=self.send_threads_limiter
+            send_executor=self.send_executor,
+            send_timeout=self.send_timeout,
+            max_queued_messages=self.max_queued_messages,
+            max_queued_bytes=self.max_queued_bytes,
+            overflow_policy=self.overflow_policy,
+            on_overflow=self.handle_slow_client
         )
 
         self.clients[client.address] = new_client
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.open(client.address)
         new_client.send_key_iv()
 
     def on_client_close(self, client):
         sleep(self.latency)
-        client_obj = self.clients[client.address]
+        client_obj = self.clients.pop(client.address)
+        client_obj.close()
+        # The requests still waiting would only answer a closed connection
+        with client_obj.requests_lock:
+            dropped = list(client_obj.pending_requests)
+            client_obj.pending_requests.clear()
+        if dropped:
+            with self.stage_lock:
+                self.db_queued -= len(dropped)
+            for _, _, deadline in dropped:
+                if deadline is not None:
+                    self.deadlines.finish(deadline)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.close(client.address)
         if client_obj.room_name is not None:
-            room_name = client_obj.room_name #because client_obj.room_name is changed in the next call
-            self.rooms[client_obj.room_name].remove_client(client_obj)
-            if len(self.rooms[room_name].clients) == 0:
-                del self.rooms[room_name]
-                logging.debug('Removing room "{}" from memory because no users are left in it'.format(room_name))
+            self.leave_room(client_obj)
 
-        del self.clients[client.address]
         # print('CLOSED: ', client.address)
-        logging.debug('{}: Disconnected'.format(client_obj.address()))
+        connection_log.debug('%s: Disconnected', client_obj)
+
+    def handle_slow_client(self, client):
+        self.close_connection(client, ewebsockets.StatusCode.ENDP_GOING_AWAY, 'Slow consumer')
 
     def close_connection(self, client, status_code=ewebsockets.StatusCode.PROTOCOL_ERROR, reason=''):
         self.server.close_connection(client.websocket, status_code=status_code, reason=reason)
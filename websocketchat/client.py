@@ -2,17 +2,46 @@
 from .crypto import *
 from time import time
 from .forms import *
-import logging
+from .wire import encode_body, encode_frame
+from .log import connection_log
 # from .chat_server import str2hex
 import json
+import threading
+from collections import deque
+
+overflow_policies = ('drop_oldest', 'coalesce', 'disconnect')
+
 
 class Client:
-    def __init__(self, websocket, send_limiter, room_name=None, name='NaN'):
+    def __init__(self, websocket, send_executor, room_name=None, name='NaN',
+                 send_timeout=-1,
+                 flush_batch=64,
+                 max_queued_messages=1000,
+                 max_queued_bytes=4*1024*1024,
+                 overflow_policy='drop_oldest',
+                 on_overflow=None):
+        """Frames are queued per client and written by send_executor (a ThreadPoolExecutor, or
+        None to send on the calling thread) flush_batch frames per task, so a slow socket only
+        holds up its own queue. When the queue is over max_queued_messages or max_queued_bytes
+        the overflow_policy decides what happens:
+
+            'drop_oldest' - the oldest droppable frames (room broadcasts) are dropped
+            'coalesce'    - all queued droppable frames are replaced by one resync message
+                            telling the client to enter the room again
+            'disconnect'  - the queue is dropped and on_overflow(client) is called
+
+        on_overflow(client) is also called when a frame can't be sent, it is expected to
+        disconnect the client.
+        """
+        if overflow_policy not in overflow_policies:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow_policy))
+
         self.name = name
         self.id = None
         self.websocket = websocket
         self.room_name = room_name
-        self.send_limiter = send_limiter
+        self.send_executor = send_executor
+        self.flush_batch = flush_batch
         self.last_activity = time()
         self.time_connected = time()
         self.logged_in = False
@@ -20,31 +49,192 @@ class Client:
         self.iv = None
         self.verification_code = None
         self.email = None
+        # Binary frames need a websocket that can send them, see wire.py
+        self.format = 'json'
+        self.available_formats = wire_formats if hasattr(websocket, 'send_binary') else ('json', )
+
+        self.send_timeout = send_timeout
+        self.max_queued_messages = max_queued_messages
+        self.max_queued_bytes = max_queued_bytes
+        self.overflow_policy = overflow_policy
+        self.on_overflow = on_overflow
+        # [frame, timeout, droppable], frame is a str for text frames and bytes for binary frames
+        self.outbox = deque()
+        self.outbox_bytes = 0
+        self.outbox_lock = threading.Lock()
+        self.flushing = False
+        self.dropped = 0
+        self.closed = False
+
+        # Validated requests waiting for the db stage, see Chat.submit_request
+        self.pending_requests = deque()
+        self.handling_requests = False
+        self.requests_lock = threading.Lock()
+
+        # It's in most log lines, built again only when the name changes (login, logout)
+        self.address_name = None
+        self.address_text = None
 
     def address(self):
-        return '{}({}:{})'.format(self.name, self.websocket.address[0], self.websocket.address[1])
+        if self.address_name != self.name:
+            self.address_text = '{}({}:{})'.format(self.name, self.websocket.address[0], self.websocket.address[1])
+            self.address_name = self.name
+        return self.address_text
+
+    def __str__(self):
+        # Log lines take the client itself so the address is only looked up when the line is written
+        return self.address()
+
+    def send(self, request_type, text, enc=False, timeout=-1, deferred=None):
+        if self.format != 'json':
+            if type(text) == str:
+                text = EncodedJson(text)
+            body = encode_body(self.format, request_type, text)
+            return self.send_frame(encode_frame(self.format, body, '1' if enc else '0', self.key, self.iv), timeout,
+                                   deferred=deferred)
 
-    def send(self, request_type, text, enc=False, timeout=-1):
         if type(text) == str:
             _text = text
-        elif type(text) == dict or type(text) == list:
+        elif type(text) == list:
+            _text = encode_array(text)
+        elif type(text) == dict:
             _text = json.JSONEncoder().encode(text)
         else:
             raise ValueError
 
+        return self.send_payload(request_type, _text, enc, timeout, deferred)
+
+    def send_payload(self, request_type, payload, enc=False, timeout=-1, deferred=None):
+        """Sends an already JSON encoded payload"""
         if enc:
-            _text = '1' + encrypt((request_type + _text).encode(), self.key, self.iv).hex()
+            _text = '1' + encrypt((request_type + payload).encode(), self.key, self.iv).hex()
+        else:
+            _text = '0' + request_type + payload
+
+        return self.send_frame(_text, timeout, deferred=deferred)
+
+    def send_text(self, text, timeout=-1, droppable=False):
+        return self.send_frame(text, timeout, droppable)
+
+    def send_frame(self, frame, timeout=-1, droppable=False, deferred=None):
+        """Queues a complete frame (str or bytes), the same frame can be handed to many clients.
+        droppable frames may be thrown away when the client can't keep up. A client that has to be
+        disconnected is only closed and appended to the deferred list when there is one, for
+        callers holding locks on_overflow may need, they call disconnect() after letting go"""
+        with self.outbox_lock:
+            if self.closed:
+                return False
+
+            self.outbox.append([frame, timeout, droppable])
+            self.outbox_bytes += len(frame)
+            overflow = len(self.outbox) > self.max_queued_messages or self.outbox_bytes > self.max_queued_bytes
+            if overflow:
+                overflow = self.handle_overflow()
+
+            start_flush = not self.flushing and len(self.outbox) > 0
+            if start_flush:
+                self.flushing = True
+
+        if overflow:
+            # The queue couldn't be shrunk, giving up on the client
+            connection_log.warning('%s: Outbound queue full (%s frames, %s bytes), disconnecting',
+                                   self, len(self.outbox), self.outbox_bytes)
+            if deferred is not None:
+                self.close()
+                deferred.append(self)
+            else:
+                self.disconnect()
+            return False
+
+        if start_flush:
+            if self.send_executor is None:
+                self.flush()
+            else:
+                self.submit_flush()
+        return True
+
+    def disconnect(self):
+        self.close()
+        if self.on_overflow is not None:
+            self.on_overflow(self)
+
+    def handle_overflow(self):
+        """Called with the outbox lock held, returns True if the client should be disconnected"""
+        if self.overflow_policy == 'disconnect':
+            return True
+
+        if self.overflow_policy == 'coalesce':
+            kept = deque(frame for frame in self.outbox if not frame[2])
+            self.dropped += len(self.outbox) - len(kept)
+            resync = encode_frame(self.format, encode_body(self.format, server_message_ids['resync']['id'], []))
+            if not any(frame[0] == resync for frame in kept):
+                kept.append([resync, -1, False])
+            self.outbox = kept
+            self.outbox_bytes = sum(len(frame[0]) for frame in kept)
         else:
-            _text = '0' + request_type + _text
+            i = 0
+            while (len(self.outbox) > self.max_queued_messages or self.outbox_bytes > self.max_queued_bytes) \
+                    and i < len(self.outbox):
+                if self.outbox[i][2]:
+                    self.outbox_bytes -= len(self.outbox[i][0])
+                    del self.outbox[i]
+                    self.dropped += 1
+                else:
+                    i += 1
+
+        return len(self.outbox) > self.max_queued_messages or self.outbox_bytes > self.max_queued_bytes
+
+    def submit_flush(self):
+        try:
+            self.send_executor.submit(self.flush)
+        except RuntimeError:
+            # The executor was shut down, the server is stopping
+            with self.outbox_lock:
+                self.flushing = False
+
+    def flush(self):
+        sent = 0
+        while True:
+            with self.outbox_lock:
+                if len(self.outbox) == 0 or self.closed:
+                    self.flushing = False
+                    return
+                if sent == self.flush_batch and self.send_executor is not None:
+                    break
+                frame, timeout, droppable = self.outbox.popleft()
+                self.outbox_bytes -= len(frame)
+
+            timeout = self.send_timeout if timeout == -1 else timeout
+            try:
+                if type(frame) == bytes:
+                    self.websocket.send_binary(frame, timeout)
+                else:
+                    self.websocket.send_text(frame, timeout)
+            except Exception as e:
+                if isinstance(e, OSError):
+                    connection_log.error('%s: Failed to send: %s', self, e)
+                else:
+                    connection_log.exception('%s: Failed to send: %s', self, e)
+                # Closing the connection too, the client would otherwise stay in its room with
+                # everything sent to it dropped
+                self.disconnect()
+                with self.outbox_lock:
+                    self.flushing = False
+                return
+            sent += 1
+
+        # Resubmitting instead of looping so slow clients can't take up every send thread
+        self.submit_flush()
+
+    def queue_depth(self):
+        return len(self.outbox)
 
-        # self.send_limiter.start_thread(
-        #     target=self.websocket.send_text,
-        #     args=(_text, timeout)
-        # )
-        return self.websocket.send_text(_text, timeout)
-        print('Sending: ', _text)
-        # print('_text')
-        # logging.debug('{}: Sent message: {}'.format(self.address(), _text))
+    def close(self):
+        """Drops the queued frames and stops any further sending"""
+        with self.outbox_lock:
+            self.closed = True
+            self.outbox.clear()
+            self.outbox_bytes = 0
 
     # def send_message(self, message, timeout=-1):
     #     self.send(message.make_json(), timeout)
@@ -67,8 +257,8 @@ class Client:
     def send_key_iv(self, timeout=-1):
         self.key, self.iv = generate_key_and_iv()
 
-        # server_message = "0y['key', 'iv']"
-        self.send(server_message_ids['key_iv']['id'], [self.key.hex(), self.iv.hex()])
+        # server_message = "0y['key', 'iv', ['json', 'msgpack']]"
+        self.send(server_message_ids['key_iv']['id'], [self.key.hex(), self.iv.hex(), list(self.available_formats)])
 
     def change_room(self, msg_id, room_name, messages, timeout=-1):
         self.room_name = room_name
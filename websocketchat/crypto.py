@@ -51,6 +51,10 @@ def generate_key_and_iv(one=False):
     else:
         return keyiv[:16], keyiv[16:]
 
+def generate_iv():
+    return Random.get_random_bytes(16)
+
+
 def hash(string):
     return sha256(string.encode()).hexdigest()
 
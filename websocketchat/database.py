@@ -1,20 +1,236 @@
 #!/bin/env python3
 
 import sqlite3
-from time import time
-import logging
+from time import time, perf_counter
 # from .chat_server import random_str
 from .crypto import hash
 import random, string
 import json
+import threading
+import queue
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from .log import db_log
 
 def random_str(n):
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(n))
 
+class MessageWriter:
+    """Write-behind queue for the messages table
+
+    Messages are queued and inserted by a single writer thread, one transaction per batch,
+    so a burst of chat lines shares one commit instead of paying for one each. Message ids
+    are allocated here rather than by SQLite so they can be handed out before the insert.
+
+    durability:
+        'commit'  - add() returns once the batch containing the message is committed
+        'enqueue' - add() returns as soon as the message is queued, messages still in the
+                    queue are lost if the process dies
+    """
+    def __init__(self, db, batch_size=100, flush_interval=0, durability='commit', queue_size=10000):
+        if durability not in ('commit', 'enqueue'):
+            raise ValueError('Unknown durability level: {}'.format(durability))
+
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.id_lock = threading.Lock()
+        self.last_id = self.get_last_id()
+        self.thread = threading.Thread(target=self.run, name='MessageWriter', daemon=True)
+        self.thread.start()
+
+    def get_last_id(self):
+        # sqlite_sequence remembers ids of deleted rows as well, AUTOINCREMENT never reuses them
+        max_id, = self.db.execute('''SELECT MAX(id) FROM messages''', fetch='one')
+        seq = self.db.execute('''SELECT seq FROM sqlite_sequence WHERE name = ?''', ('messages',), fetch='one')
+        return max(max_id or 0, seq[0] if seq is not None else 0)
+
+    def add(self, entries):
+        done = threading.Event() if self.durability == 'commit' else None
+        row = tuple(entries[column] for column in self.db.message_columns)
+        # Queued under the lock as well so the rows are written (and seen by readers paging by
+        # id) in id order, a lower id committed later could be skipped by id > last_id
+        with self.id_lock:
+            self.last_id += 1
+            message_id = self.last_id
+            # [row, done, error]
+            item = [(message_id, ) + row, done, None]
+            self.queue.put(item)
+
+        if done is not None:
+            done.wait()
+            if item[2] is not None:
+                raise item[2]
+
+        return message_id
+
+    def run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    if self.flush_interval > 0:
+                        item = self.queue.get(timeout=max(deadline - time(), 0))
+                    else:
+                        item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self.write(batch)
+
+        # Flushing whatever was queued after the stop request
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        command = '''INSERT INTO messages(id, {}) VALUES(?{})'''.format(
+            ', '.join(self.db.message_columns), ', ?'*len(self.db.message_columns))
+        error = None
+        try:
+            with self.db.transaction() as cursor:
+                cursor.executemany(command, [item[0] for item in batch])
+        except sqlite3.Error as e:
+            db_log.error('Failed to write %s queued messages: %s', len(batch), e)
+            error = e
+
+        for item in batch:
+            item[2] = error
+            if item[1] is not None:
+                item[1].set()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ConnectionManager:
+    """One writer connection shared under a lock plus a pool of read-only connections
+
+    The database is put in WAL mode so readers never wait for the writer (and the other
+    way around). A read connection is only held by one thread at a time, threads block
+    when read_pool_size connections are checked out.
+    """
+    def __init__(self, name,
+                 wal=True,
+                 synchronous='NORMAL',
+                 mmap_size=268435456,
+                 cache_size=-16000,
+                 busy_timeout=5000,
+                 read_pool_size=8):
+        self.name = name
+        self.pragmas = {'mmap_size': mmap_size,
+                        'cache_size': cache_size,
+                        'busy_timeout': busy_timeout}
+        # An in-memory database only exists on the writer connection
+        self.shared = name == ':memory:' or name == ''
+        self.write_lock = threading.RLock()
+        self.writer = self.connect()
+        if wal and not self.shared:
+            mode, = self.writer.execute('''PRAGMA journal_mode = WAL''').fetchone()
+            if mode.lower() != 'wal':
+                db_log.warning('%s: Could not enable WAL journaling (journal_mode=%s)', name, mode)
+        self.writer.execute('''PRAGMA synchronous = {}'''.format(synchronous))
+
+        self.read_pool_size = read_pool_size
+        self.idle_readers = queue.LifoQueue()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.readers_available = threading.Semaphore(read_pool_size)
+
+    def connect(self, read_only=False):
+        if read_only:
+            connection = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(self.name)),
+                                         uri=True, check_same_thread=False)
+            connection.execute('''PRAGMA query_only = 1''')
+        else:
+            connection = sqlite3.connect(self.name, check_same_thread=False)
+
+        for pragma in self.pragmas:
+            if self.pragmas[pragma] is not None:
+                connection.execute('''PRAGMA {} = {}'''.format(pragma, int(self.pragmas[pragma])))
+        return connection
+
+    @contextmanager
+    def read_connection(self):
+        if self.shared:
+            with self.write_lock:
+                yield self.writer
+            return
+
+        self.readers_available.acquire()
+        try:
+            try:
+                connection = self.idle_readers.get_nowait()
+            except queue.Empty:
+                connection = self.connect(read_only=True)
+                with self.readers_lock:
+                    self.readers.append(connection)
+            try:
+                yield connection
+            finally:
+                self.idle_readers.put(connection)
+        finally:
+            self.readers_available.release()
+
+    def close(self):
+        with self.readers_lock:
+            for connection in self.readers:
+                connection.close()
+            self.readers = []
+        with self.write_lock:
+            self.writer.close()
+
+
 class ChatDb:
-    def __init__(self):
-        self.name = 'chat.db'
-        self.db = sqlite3.connect('chat.db', check_same_thread=False)
+    def __init__(self, name='chat.db',
+                 write_behind=False,
+                 write_batch_size=100,
+                 write_flush_interval=0,
+                 write_durability='commit',
+                 write_queue_size=10000,
+                 token_lifetime=30*24*3600,
+                 max_tokens=10,
+                 metrics=None,
+                 tracer=None,
+                 **connection_kwargs):
+        """connection_kwargs are passed on to ConnectionManager (wal, synchronous, mmap_size,
+        cache_size, busy_timeout, read_pool_size). With metrics (a metrics.Metrics) the time of
+        every execute is recorded, with tracer (a profiling.Tracer) every execute is a span"""
+        self.name = name
+        self.connections = ConnectionManager(name, **connection_kwargs)
+        self.db = self.connections.writer
+        self.lock = self.connections.write_lock
+        self.token_lifetime = token_lifetime
+        self.max_tokens = max_tokens
+        self.execute_seconds = None
+        self.execute_errors = None
+        self.tracer = tracer
+        if metrics is not None:
+            self.execute_seconds = {
+                'read': metrics.histogram('chat_db_execute_seconds', 'Time of ChatDb.execute', kind='read'),
+                'write': metrics.histogram('chat_db_execute_seconds', 'Time of ChatDb.execute', kind='write')}
+            self.execute_errors = metrics.counter('chat_db_errors_total', 'ChatDb.execute calls that raised')
         # self.cursor = self.db.cursor()
         self.tables = {'users': {'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
                                  'name': 'TEXT NOT NULL',
@@ -34,34 +250,100 @@ class ChatDb:
                                     'time': 'INTEGER NOT NULL'},
                        'rooms': {'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
                                  'name': 'TEXT NOT NULL',
-                                 'created': 'INTEGER NOT NULL'}
+                                 'created': 'INTEGER NOT NULL'},
+                       # Login tokens, only the sha256 of the token is stored
+                       'tokens': {'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+                                  'user_id': 'INTEGER NOT NULL',
+                                  'token_hash': 'TEXT NOT NULL',
+                                  'created': 'INTEGER NOT NULL',
+                                  'expires': 'INTEGER NOT NULL'}
 
                        }
+        # name: (table, columns)
+        self.indexes = {'messages_room_name_id': ('messages', ('room_name', 'id')),
+                        'users_email': ('users', ('email',)),
+                        'users_name': ('users', ('name',)),
+                        'tokens_token_hash': ('tokens', ('token_hash',)),
+                        'tokens_user_id': ('tokens', ('user_id', 'id'))}
+        self.message_columns = ('user', 'text', 'room_name', 'show', 'time')
         self.create_tables()
 
+        self.writer = None
+        if write_behind:
+            self.writer = MessageWriter(self,
+                                        batch_size=write_batch_size,
+                                        flush_interval=write_flush_interval,
+                                        durability=write_durability,
+                                        queue_size=write_queue_size)
+
     def connect(self):
         # return sqlite3.connect(self.name)
         return self.db
 
     def close(self):
-        self.db.close()
+        if self.writer is not None:
+            # Flushes the queued messages before the connection goes away
+            self.writer.stop()
+            self.writer = None
+        self.connections.close()
+
+    @contextmanager
+    def transaction(self):
+        """Runs several writes on the writer connection as one transaction"""
+        with self.lock:
+            cursor = self.db.cursor()
+            try:
+                yield cursor
+            except:
+                self.db.rollback()
+                raise
+            else:
+                self.db.commit()
 
     def execute(self, command, entries=(), commit=False, fetch=None):
-        # db = sqlite3.connect(self.name)
-        cursor = self.db.cursor()
-        row_id = None
-
-        cursor.execute(command, entries)
-
-        if commit:
-            row_id = cursor.lastrowid
-            self.db.commit()
-            return row_id
-
-        if fetch == 'one':
-            return cursor.fetchone()
-        elif fetch == 'all':
-            return cursor.fetchall()
+        if self.execute_seconds is None and self.tracer is None:
+            return self.run_command(command, entries, commit, fetch)
+
+        start = perf_counter()
+        try:
+            return self.run_command(command, entries, commit, fetch)
+        except sqlite3.Error:
+            if self.execute_errors is not None:
+                self.execute_errors.inc()
+            raise
+        finally:
+            end = perf_counter()
+            if self.execute_seconds is not None:
+                kind = 'read' if fetch is not None and not commit else 'write'
+                self.execute_seconds[kind].observe(end - start)
+            if self.tracer is not None:
+                self.tracer.add('ChatDb.execute', start, end)
+
+    def run_command(self, command, entries=(), commit=False, fetch=None):
+        if fetch is not None and not commit:
+            # Plain reads go to the read pool and run in parallel with the writer
+            with self.connections.read_connection() as connection:
+                cursor = connection.execute(command, entries)
+                if fetch == 'one':
+                    return cursor.fetchone()
+                else:
+                    return cursor.fetchall()
+
+        with self.lock:
+            cursor = self.db.cursor()
+            row_id = None
+
+            cursor.execute(command, entries)
+
+            if commit:
+                row_id = cursor.lastrowid
+                self.db.commit()
+                return row_id
+
+            if fetch == 'one':
+                return cursor.fetchone()
+            elif fetch == 'all':
+                return cursor.fetchall()
 
     def insert(self, table, entries):
         # db = self.connect()
@@ -88,10 +370,44 @@ class ChatDb:
         columns = ', '.join(columns)
         self.execute('''CREATE TABLE IF NOT EXISTS {}({})'''.format(name, columns), commit=True)
 
+    def create_index(self, name, table, columns):
+        self.execute('''CREATE INDEX IF NOT EXISTS {} ON {}({})'''.format(name, table, ', '.join(columns)),
+                     commit=True)
+
     def create_tables(self):
         for table in self.tables:
             self.create_table(table, self.tables[table])
 
+        # Indexes are created with IF NOT EXISTS so older databases are migrated on startup
+        for index in self.indexes:
+            self.create_index(index, *self.indexes[index])
+
+        self.migrate_tokens()
+
+    def migrate_tokens(self):
+        # Tokens used to be stored as a JSON list in users.tokens, moving them to the tokens table
+        users = self.execute('''SELECT id, tokens FROM users WHERE tokens != '[]' ''', fetch='all')
+        if not users:
+            return
+
+        t = time()
+        moved = 0
+        with self.transaction() as cursor:
+            for user_id, tokens in users:
+                try:
+                    tokens = json.JSONDecoder().decode(tokens)
+                except json.JSONDecodeError:
+                    db_log.error('User %s has corrupt tokens, dropping them', user_id)
+                    tokens = []
+
+                for token in tokens[-self.max_tokens:]:
+                    cursor.execute('''INSERT INTO tokens(user_id, token_hash, created, expires) VALUES(?, ?, ?, ?)''',
+                                   (user_id, hash(token), t, t + self.token_lifetime))
+                    moved += 1
+                cursor.execute('''UPDATE users SET tokens = '[]' WHERE id = ?''', (user_id, ))
+
+        db_log.info('Moved %s tokens of %s users to the tokens table', moved, len(users))
+
     def check_existence(self, table, column, entry):
         command = '''SELECT id FROM {} WHERE {}=?'''.format(table, column)
         # db = self.connect()
@@ -128,41 +444,38 @@ class ChatDb:
 
     def add_message(self, client, text, show=1):
         t = time()
-
-        id = self.insert('messages', {
+        entries = {
                 'user': client.name,
                 'text': text,
                 'room_name': client.room_name,
                 'show': show,
-                'time': t})
+                'time': t}
+
+        if self.writer is None:
+            id = self.insert('messages', entries)
+        else:
+            id = self.writer.add(entries)
 
         return id, t
 
     def get_messages(self, room_name, last_id, latest):
-        messages = self.execute('''SELECT id, time, user, text FROM messages WHERE room_name = ? AND id > ?''',
-                            (room_name, last_id), fetch='all')
-        length = len(messages)
-        if length > latest:
-            messages = messages[length-latest:]
-
+        # Walks the (room_name, id) index backwards so only the requested rows are read,
+        # then restores chronological order
+        messages = self.execute('''SELECT id, time, user, text FROM messages WHERE room_name = ? AND id > ?
+                                   ORDER BY id DESC LIMIT ?''',
+                                (room_name, last_id, latest), fetch='all')
+        messages.reverse()
         return messages
 
     def validate_login(self, email, password, request_token):
-        if request_token:
-            command = '''SELECT id, name, password, salt, verification_code, tokens FROM users WHERE email = ?'''
-        else:
-            command = '''SELECT id, name, password, salt, verification_code FROM users WHERE email = ?'''
-
+        command = '''SELECT id, name, password, salt, verification_code FROM users WHERE email = ?'''
         data = self.execute(command, (email,), fetch='one')
 
         if data is None:
             # No user with that email was found
             return
 
-        if request_token:
-            user_id, name, stored_password, salt, verification_code, tokens = data
-        else:
-            user_id, name, stored_password, salt, verification_code = data
+        user_id, name, stored_password, salt, verification_code = data
 
         salted_password = hash(password + salt)
         if salted_password == stored_password:
@@ -171,16 +484,7 @@ class ChatDb:
 
             token = ''
             if request_token:
-                tokens = json.JSONDecoder().decode(tokens)
-                token = random_str(32)
-                tokens.append(token)
-                if len(tokens) > 10:
-                    # Maximum saved tokens set to 10
-                    tokens = tokens[1:]
-
-                tokens = json.JSONEncoder().encode(tokens)
-                command = '''UPDATE users SET tokens = ? WHERE Id = ?'''
-                self.execute(command, (tokens, user_id), commit=True)
+                token = self.add_token(user_id)
 
             return user_id, name, request_email_verification, token
         else:
@@ -188,35 +492,38 @@ class ChatDb:
 
     def validate_auto_login(self, client, email, token):
             data = self.execute(
-                '''SELECT id, name, tokens, verification_code FROM users WHERE email = ?''',
-                (email,), fetch='one'
+                '''SELECT tokens.id, tokens.expires, users.id, users.name, users.verification_code FROM tokens
+                   JOIN users ON users.id = tokens.user_id WHERE tokens.token_hash = ? AND users.email = ?''',
+                (hash(token), email), fetch='one'
             )
             if data is None:
+                # An unknown token might be an old one that was stolen and already rotated
+                db_log.debug('%s: Deleting tokens', client)
+                self.execute('''DELETE FROM tokens WHERE user_id IN (SELECT id FROM users WHERE email = ?)''',
+                             (email, ), commit=True)
                 return
 
-            user_id, name, tokens, verification_code = data
-            tokens = json.JSONDecoder().decode(tokens)
-
-            if token in tokens:
-                tokens.remove(token)
-                new_token = random_str(32)
-                tokens.append(new_token)
+            token_id, expires, user_id, name, verification_code = data
+            t = time()
+            if expires <= t:
+                db_log.debug('%s: Token expired', client)
+                self.execute('''DELETE FROM tokens WHERE id = ?''', (token_id, ), commit=True)
+                return
 
-                self.execute('''UPDATE users SET tokens=? WHERE Id = ?''',
-                                    (json.JSONEncoder().encode(tokens), user_id),
-                             commit=True)
-                request_email_verification = verification_code is not None
-
-                return user_id, name, new_token, request_email_verification
-            else:
-                logging.debug('{}: Deleting tokens'.format(client.address()))
-                tokens = []
-                self.execute('''UPDATE users SET tokens=? WHERE email = ?''',
-                                    (json.JSONEncoder().encode(tokens), email),
-                             commit=True)
+            new_token = random_str(32)
+            with self.transaction() as cursor:
+                # Matching on the old hash as well so only one of two concurrent logins gets the token
+                cursor.execute('''UPDATE tokens SET token_hash = ?, created = ?, expires = ?
+                                  WHERE id = ? AND token_hash = ?''',
+                               (hash(new_token), t, t + self.token_lifetime, token_id, hash(token)))
+                rotated = cursor.rowcount == 1
 
+            if not rotated:
                 return
 
+            request_email_verification = verification_code is not None
+            return user_id, name, new_token, request_email_verification
+
     def new_user(self, email, name, password):
         salt = random_str(32)
         salted_password = hash(password + salt)
@@ -233,31 +540,24 @@ class ChatDb:
         })
         return user_id, verification_code
 
-    def new_token(self, client):
-        tokens, = self.execute('''SELECT tokens FROM users WHERE id = ?''', (client.id,), fetch='one')
-        tokens = json.JSONDecoder().decode(tokens)
+    def add_token(self, user_id):
         token = random_str(32)
-        tokens.append(token)
-        if len(tokens) > 10:
-            logging.debug('{}: too many tokens removing oldest'.format(client.address()))
-            tokens = tokens[len(tokens)-10:]
-
-        self.execute('''UPDATE users SET tokens=? WHERE Id=?''',
-                     (json.JSONEncoder().encode(tokens), client.id),
-                     commit=True)
-
+        t = time()
+        with self.transaction() as cursor:
+            cursor.execute('''INSERT INTO tokens(user_id, token_hash, created, expires) VALUES(?, ?, ?, ?)''',
+                           (user_id, hash(token), t, t + self.token_lifetime))
+            # Only the newest max_tokens tokens are kept
+            cursor.execute('''DELETE FROM tokens WHERE user_id = ? AND id NOT IN
+                              (SELECT id FROM tokens WHERE user_id = ? ORDER BY id DESC LIMIT ?)''',
+                           (user_id, user_id, self.max_tokens))
         return token
 
-    def remove_token(self, client, token):
-        tokens, = self.execute('''SELECT tokens FROM users WHERE id = ?''', (client.id,), fetch='one')
-        tokens = json.JSONDecoder().decode(tokens)
-
-        if token in tokens:
-            tokens.remove(token)
+    def new_token(self, client):
+        return self.add_token(client.id)
 
-        self.execute('''UPDATE users SET tokens=? WHERE Id=?''',
-                     (json.JSONEncoder().encode(tokens), client.id),
-                     commit=True)
+    def remove_token(self, client, token):
+        self.execute('''DELETE FROM tokens WHERE token_hash = ? AND user_id = ?''',
+                     (hash(token), client.id), commit=True)
 
         return token
 
@@ -278,7 +578,7 @@ class ChatDb:
         new_verification_code = random_str(7)
         command = '''UPDATE users SET verification_code = ? WHERE id = ?'''
 
-        self.execute(command, (new_verification_code, user_id))
+        self.execute(command, (new_verification_code, user_id), commit=True)
 
         return new_verification_code
 
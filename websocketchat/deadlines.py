@@ -0,0 +1,93 @@
+#!/bin/env python3
+"""Deadlines of the requests being handled
+
+Every request gets a deadline when it is read. Whichever comes first, the request finishing
+or the deadline expiring, wins: a request finishing after its deadline has its response
+dropped, an expired deadline calls on_expire (which tells the client) from the watcher thread.
+"""
+
+import heapq
+import threading
+from time import monotonic
+from .log import request_log
+
+
+class Deadline:
+    __slots__ = ('time', 'on_expire', 'done')
+
+    def __init__(self, time, on_expire):
+        self.time = time
+        self.on_expire = on_expire
+        self.done = False
+
+    def __lt__(self, other):
+        return self.time < other.time
+
+
+class DeadlineWatcher:
+    def __init__(self):
+        # Finished deadlines are left in the heap until their time comes
+        self.heap = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.expired_count = 0
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='DeadlineWatcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add(self, timeout, on_expire):
+        deadline = Deadline(monotonic() + timeout, on_expire)
+        with self.condition:
+            heapq.heappush(self.heap, deadline)
+            # Only the watcher waiting for a later deadline needs waking up
+            if self.heap[0] is deadline:
+                self.condition.notify()
+        return deadline
+
+    def expired(self, deadline):
+        """True if on_expire was called, for deadlines that aren't finished yet"""
+        with self.condition:
+            return deadline.done
+
+    def finish(self, deadline):
+        """Returns False if the deadline already expired"""
+        with self.condition:
+            if deadline.done:
+                return False
+            deadline.done = True
+            return True
+
+    def run(self):
+        while True:
+            expired = []
+            with self.condition:
+                if not self.running:
+                    return
+                now = monotonic()
+                while self.heap and (self.heap[0].done or self.heap[0].time <= now):
+                    deadline = heapq.heappop(self.heap)
+                    if not deadline.done:
+                        deadline.done = True
+                        expired.append(deadline)
+                if not expired:
+                    self.condition.wait(self.heap[0].time - now if self.heap else None)
+
+            for deadline in expired:
+                self.expired_count += 1
+                try:
+                    deadline.on_expire()
+                except Exception as e:
+                    request_log.exception('Failed to handle an expired deadline: %s', e)
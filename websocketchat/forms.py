@@ -1,8 +1,25 @@
 #!/bin/env python3
 
-import validators
 import re
 import json
+import ipaddress
+from urllib.parse import unquote
+
+# Compiled once here instead of on every call
+email_pattern = re.compile(r'^(([^<>()\[\]\\.,;:\s@"]+(\.[^<>()\[\]\\.,;:\s@"]+)*)|(".+"))@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}])|(([a-zA-Z\-0-9]+\.)+[a-zA-Z]{2,}))$')
+username_pattern = re.compile('^[A-Za-z][A-Za-z0-9]*$')
+hexstring_pattern = re.compile('^[A-Fa-f0-9]+$')
+# Room names are urls without the scheme, [user[:password]@]host[:port][/path][?query][#fragment].
+# They are accepted when validators.url (0.36) accepts 'http://' + name, these are its rules.
+room_name_pattern = re.compile(r'^(?:([^/?#@]*)@)?([^/?#@]+)([/?#].*)?$', re.DOTALL)
+room_user_pattern = re.compile(r'^(?:[\u0100-\u024f]|[\x01-\x08\x0b\x0c\x0e-\x1f!#-\[\]-\x7f]*$)')
+room_port_pattern = re.compile(r'^(?:6553[0-5]|655[0-2][0-9]|65[0-4][0-9]{2}|6[0-4][0-9]{3}|[1-5][0-9]{4}|[1-9][0-9]{0,3})$')
+room_domain_pattern = re.compile(r'^(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z0-9][a-z0-9-]{0,61}[a-z]$', re.IGNORECASE)
+room_path_pattern = re.compile(r'^[/a-z0-9\-._~!$&\'()*+,;=:@%\U0001f300-\U0001f64f'
+                               r'\u00a0-\ud7ff\uf900-\ufdcf\ufdf0-\uffef]+$', re.IGNORECASE)
+room_fragment_pattern = re.compile(r"^[0-9a-z?/:@\-._~%!$&'()*+,;=#]*$", re.IGNORECASE)
+ipvfuture_pattern = re.compile(r'^v[a-fA-F0-9]+\..+$', re.DOTALL)
+whitespace_pattern = re.compile(r'\s')
 
 
 def is_int(input):
@@ -25,23 +42,97 @@ def is_email(input):
     if not is_str(input):
         return False
 
-    regex = r'^(([^<>()\[\]\\.,;:\s@"]+(\.[^<>()\[\]\\.,;:\s@"]+)*)|(".+"))@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}])|(([a-zA-Z\-0-9]+\.)+[a-zA-Z]{2,}))$'
-    pattern = re.compile(regex)
+    return email_pattern.match(input) is not None
 
-    if not pattern.match(input):
+
+def is_url(input):
+    if not is_str(input) or len(input) > 2000 or whitespace_pattern.search(input):
         return False
 
-    return True
+    match = room_name_pattern.match(input)
+    if match is None:
+        return False
+    user, host, rest = match.groups()
+    netloc = input[:match.end(2)]
+    if ('[' in netloc or ']' in netloc) and not is_bracketed_host(netloc):
+        return False
+    if user and not is_room_user(user):
+        return False
+    if not is_room_host(host):
+        return False
+    if rest is None:
+        return True
 
-    # return validators.email(input) == True
+    rest, _, fragment = rest.partition('#')
+    path, _, query = rest.partition('?')
+    if path and room_path_pattern.match(path) is None:
+        return False
+    # Every field of the query needs an =, with & as the separator and also with ; when a &
+    # field has a value (validators.url doesn't look further when none has)
+    if query:
+        fields = query.split('&')
+        if not all('=' in field for field in fields):
+            return False
+        if any(field.split('=', 1)[1] for field in fields) and \
+                not all('=' in field for field in query.split(';')):
+            return False
+    return room_fragment_pattern.match(fragment) is not None
+
+
+def is_bracketed_host(netloc):
+    # What urlsplit accepts in brackets, an ipv6 address or an IPvFuture
+    if '[' not in netloc or ']' not in netloc:
+        return False
+    host = netloc.partition('[')[2].partition(']')[0]
+    if host.startswith('v'):
+        return ipvfuture_pattern.match(host) is not None
+    try:
+        return ipaddress.ip_address(host).version == 6
+    except ValueError:
+        return False
 
 
-def is_url(input):
-    input = 'http://' + input
-    if not is_str(input):
+def is_room_user(user):
+    if user.count(':') > 1:
+        return room_user_pattern.match(unquote(user)) is not None
+    return room_user_pattern.match(user.split(':', 1)[0]) is not None
+
+
+def is_room_host(host):
+    # An ipv6 address is in brackets, a port after them or after the only colon
+    ipv6 = host.startswith('[') and host.count(':') >= 2
+    if ipv6 and ']:' not in host:
+        host = host[1:].replace(']', '', 1)
+    if host.count(']:') == 1 or host.count(':') == 1:
+        name, port = host.rsplit(':', 1)
+        if room_port_pattern.match(port) is not None:
+            host = name.lstrip('[').rstrip(']') if ']:' in host else name
+
+    if is_domain(host):
+        return True
+    try:
+        ipaddress.IPv4Address(host)
+        return True
+    except ValueError:
+        pass
+    if not ipv6:
+        return False
+    try:
+        ipaddress.IPv6Address(host)
+        return True
+    except ValueError:
         return False
 
-    return validators.url(input) == True
+
+def is_domain(host):
+    if '__' in host:
+        return False
+    if not host.isascii():
+        try:
+            host = host.encode('idna').decode('utf-8')
+        except UnicodeError:
+            return False
+    return len(host) <= 253 and room_domain_pattern.match(host) is not None
 
 
 def validate_username(input):
@@ -51,34 +142,29 @@ def validate_username(input):
     if len(input) < 3 or len(input) > 15:
         return False
 
-    regex = '^[A-Za-z][A-Za-z0-9]*$'
-    pattern = re.compile(regex)
-
-    if not pattern.match(input):
-        return False
-
-    return True
+    return username_pattern.match(input) is not None
 
 
 def validate_hexstring(input):
     if not is_str(input):
         return False
-    # It has to be even
-    length = len(input)
-    if length/2 != int(length/2):
-        return False
 
-    # It has to be a multiple of 16
-    if length/16 != int(length/16):
+    # It has to be a multiple of 16 (and so even)
+    if len(input) % 16 != 0:
         return False
 
-    regex = '^[A-Fa-f0-9]+$'
-    pattern = re.compile(regex)
-    if pattern.match(input):
-        return True
-    else:
-        return False
+    return hexstring_pattern.match(input) is not None
+
+
+# See wire.py
+wire_formats = ('json', 'msgpack')
 
+
+def is_wire_format(input):
+    return is_str(input) and input in wire_formats
+
+# 'ordered': False requests don't change any state, they can run next to the other requests of
+# the client and be answered out of order (responses start with the msg_id of the request)
 request_ids = {
     '1': {
         'type': 'send_message',
@@ -86,7 +172,8 @@ request_ids = {
         'expected_types': [str],
         'description': ['text'],
         'validators': [is_str],
-        'response': []
+        'response': [],
+        'ordered': True
     },
     # '2': { # Messages are now automatically sent on enter_room request
     #     'type': 'get_messages',
@@ -102,7 +189,8 @@ request_ids = {
         'expected_types': [str, str, int],
         'description': ['email', 'password', 'request_token'],
         'validators': [is_email, is_str, is_bool],
-        'response': ['accepted', 'name', 'request_email_verification', 'token']
+        'response': ['accepted', 'name', 'request_email_verification', 'token'],
+        'ordered': True
     },
     '6': {
         'type': 'enter_room',
@@ -110,7 +198,8 @@ request_ids = {
         'expected_types': [str, int],
         'description': ['room_name', 'last_id'],
         'validators': [is_url, is_int],
-        'response': ['messages']
+        'response': ['messages'],
+        'ordered': True
     },
     '7': {
         'type': 'check_username',
@@ -118,7 +207,8 @@ request_ids = {
         'expected_types': [str],
         'description': ['name'],
         'validators': [validate_username],
-        'response': ['is_available']
+        'response': ['is_available'],
+        'ordered': False
     },
     '8': {
         'type': 'check_email',
@@ -126,7 +216,8 @@ request_ids = {
         'expected_types': [str],
         'description': ['email'],
         'validators': [is_email],
-        'response': ['is_available']
+        'response': ['is_available'],
+        'ordered': False
     },
     '9': {
         'type': 'register',
@@ -134,7 +225,8 @@ request_ids = {
         'expected_types': [str, str, str],
         'description': ['email', 'name', 'password'],
         'validators': [is_email, validate_username, is_str],
-        'response': ['accepted', 'email_available', 'name_available']
+        'response': ['accepted', 'email_available', 'name_available'],
+        'ordered': True
     },
     'a': {
         'type': 'verify_email',
@@ -142,7 +234,8 @@ request_ids = {
         'expected_types': [str],
         'description': ['verification_code'],
         'validators': [is_str],
-        'response': ['accepted']
+        'response': ['accepted'],
+        'ordered': True
     },
     'b': {
         'type': 'token_login',
@@ -150,7 +243,8 @@ request_ids = {
         'expected_types': [str, str],
         'description': ['email', 'token'],
         'validators': [is_email, is_str],
-        'response': ['accepted', 'request_email_verification', 'name']
+        'response': ['accepted', 'request_email_verification', 'name'],
+        'ordered': True
     },
     'c': {
         'type': 'logout',
@@ -158,7 +252,8 @@ request_ids = {
         'expected_types': [str],
         'description': ['token'],
         'validators': [is_str],
-        'response': []
+        'response': [],
+        'ordered': True
     },
     'd': {
         'type': 'new_verification_code',
@@ -166,20 +261,168 @@ request_ids = {
         'expected_types': [],
         'description': [],
         'validators': [],
-        'response': []
+        'response': [],
+        'ordered': True
+    },
+    'e': {
+        'type': 'set_format',
+        'expected_length': 1,
+        'expected_types': [str],
+        'description': ['format'],
+        'validators': [is_wire_format],
+        'response': ['accepted'],
+        'ordered': True
+    },
+    # f[msg_id, [request_id, msg_id, ...], [request_id, msg_id, ...], ...], the sub-requests are
+    # handled in order and answered together with [msg_id, [[request_id, msg_id, ...], ...]]
+    'f': {
+        'type': 'batch',
+        'expected_length': None,  # 1 to max_batch_size sub-requests, see validate_batch
+        'expected_types': [list],
+        'description': ['requests'],
+        'validators': [],
+        'response': ['responses'],
+        'ordered': True
     }
 }
 
+max_batch_size = 16
+
 server_message_ids = {
     'single_message': {
         'id': 'z'
     },
+    # [key, iv, formats], formats are the wire formats the connection supports
     'key_iv': {
         'id': 'y'
+    },
+    # [key] of the room, sent encrypted with the client key on room entry and key rotation.
+    # Frames encrypted with the room key start with '2' instead of '1', followed by their own iv
+    'room_key': {
+        'id': 'x'
+    },
+    # [], room messages were dropped because the client was too slow, enter the room again
+    'resync': {
+        'id': 'w'
+    },
+    # [msg_id, request_id], the request wasn't handled in time and won't be answered
+    'request_timeout': {
+        'id': 'v'
     }
 }
 
 
+class EncodedJson(str):
+    """A value that is already JSON encoded, encode_array inserts it as it is"""
+    # The MessagePack encoding, set by wire.pack the first time the value goes to a msgpack client
+    packed = None
+
+
+def contains_encoded(array):
+    for item in array:
+        if type(item) == EncodedJson or (type(item) == list and contains_encoded(item)):
+            return True
+    return False
+
+
+def encode_array(array):
+    if not contains_encoded(array):
+        return json.JSONEncoder().encode(array)
+
+    # EncodedJson items can also be inside nested lists (batch responses)
+    encoder = json.JSONEncoder()
+    return '[' + ', '.join(item if type(item) == EncodedJson else
+                           encode_array(item) if type(item) == list else
+                           encoder.encode(item) for item in array) + ']'
+
+
+def compile_validator(req):
+    """Turns a request_ids entry into one function validating a decoded request_array,
+    returning the same (accepted, info) as validate_request"""
+    request_type = req['type']
+    expected_length = req['expected_length'] + 1
+    # (position in request_array, validator, description)
+    checks = tuple(zip(range(1, expected_length), req['validators'], req['description']))
+
+    missing_msg_id = 'request_array is missing an msg_id in request {}'.format(request_type)
+    wrong_msg_id = 'msg_id is of wrong type or missing in request {}'.format(request_type)
+    wrong_length = 'Unexpected length in request {}'.format(request_type)
+    not_a_list = 'request_array is not of type<list> after conversion in request {}'.format(request_type)
+
+    def validate(request_array):
+        if type(request_array) != list:
+            return False, not_a_list
+
+        length = len(request_array)
+        if length == 0:
+            return False, missing_msg_id
+
+        if type(request_array[0]) != int:
+            return False, wrong_msg_id
+
+        if length != expected_length:
+            return False, wrong_length
+
+        for i, validator, description in checks:
+            if not validator(request_array[i]):
+                return False, 'Failed when validating {} ({}) of request {}'.format(
+                    description, request_array[i], request_type
+                )
+
+        return True, None
+
+    return validate
+
+
+request_validators = {request_id: compile_validator(request_ids[request_id]) for request_id in request_ids
+                      if request_ids[request_id]['expected_length'] is not None}
+
+
+def validate_batch(request_array):
+    if type(request_array) != list:
+        return False, 'request_array is not of type<list> after conversion in request batch'
+
+    if len(request_array) == 0:
+        return False, 'request_array is missing an msg_id in request batch'
+
+    if type(request_array[0]) != int:
+        return False, 'msg_id is of wrong type or missing in request batch'
+
+    if not 1 <= len(request_array) - 1 <= max_batch_size:
+        return False, 'Unexpected length in request batch'
+
+    for request in request_array[1:]:
+        if type(request) != list or len(request) == 0 or type(request[0]) != str:
+            return False, 'Sub-request {} is not [request_id, msg_id, ...] in request batch'.format(request)
+
+        validator = request_validators.get(request[0])
+        # Batches can't be nested
+        if validator is None or validator is validate_batch:
+            return False, 'Invalid request id {} in request batch'.format(request[0])
+
+        accepted, info = validator(request[1:])
+        if not accepted:
+            return False, '{} (in request batch)'.format(info)
+
+    return True, None
+
+
+request_validators['f'] = validate_batch
+json_decoder = json.JSONDecoder()
+
+
+def validate_request_array(request_id, request_array):
+    """Validates an already decoded request, used for requests that don't arrive as JSON"""
+    if request_id not in request_validators:
+        return False, 'Invalid request id'
+
+    accepted, info = request_validators[request_id](request_array)
+    if not accepted:
+        return False, info
+
+    return True, [request_id, request_array]
+
+
 def validate_request(request):
     """Handling of encryption happens prior to this function call
      so the structure of the request looks like:
@@ -194,36 +437,18 @@ def validate_request(request):
         return False, 'Request length < 4 (minimum e.x. "1[1]"'
 
     request_id = request[0]
-    if request_id not in request_ids:
+    validator = request_validators.get(request_id)
+    if validator is None:
         return False, 'Invalid request id'
 
-    req = request_ids[request_id]
     # Trying to decode rest of the request as a list
     try:
-        request_array = json.JSONDecoder().decode(request[1:])
+        request_array = json_decoder.decode(request[1:])
     except json.JSONDecodeError:
-        return False, 'Failed to convert request_array to list in request {}'.format(req['type'])
+        return False, 'Failed to convert request_array to list in request {}'.format(request_ids[request_id]['type'])
 
-    if not is_list(request_array):
-        return False, 'request_array is not of type<list> after conversion in request {}'.format(req['type'])
-
-    length = len(request_array)
-    if length == 0:
-        return False, 'request_array is missing an msg_id in request {}'.format(req['type'])
-
-    msg_id = request_array[0]
-    if not is_int(msg_id):
-        return False, 'msg_id is of wrong type or missing in request {}'.format(req['type'])
-
-    if length-1 != req['expected_length']:
-        return False, 'Unexpected length in request {}'.format(req['type'])
-
-    for i in range(length-1):
-        # [i+1] because msg_id is missing in the request_ids['validators'] list
-        if not req['validators'][i](request_array[i+1]):
-            return False, 'Failed when validating {} ({}) of request {}'.format(
-                req['description'][i], request_array[i+1], req['type']
-            )
+    accepted, info = validator(request_array)
+    if not accepted:
+        return False, info
 
     return True, [request_id, request_array]
-
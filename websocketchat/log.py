@@ -0,0 +1,133 @@
+#!/bin/env python3
+"""Log categories and logging that stays off the threads handling the clients
+
+The server logs to a logger per category so each can have its own level and sampling:
+
+    websocketchat.server       start, stop, capture and profiling
+    websocketchat.connections  disconnects, slow clients and failed sends
+    websocketchat.requests     the request handlers
+    websocketchat.rooms        rooms loaded and removed, members entering and leaving, broadcasts
+    websocketchat.protocol     frames that could not be decrypted or are not a valid request
+    websocketchat.db           the database and the queued message writes
+    websocketchat.pubsub       the broker and the connections of the nodes to it
+
+Messages are %-style with the arguments passed along ('%s: logged out', client) so nothing is
+formatted for a disabled level. start_logging moves the handlers behind a queue:
+
+    start_logging(level=logging.INFO, sampling={'websocketchat.protocol': 100})
+
+The message of a record is put together when it is queued (the arguments can be clients that
+change right after the call) and the record is formatted and written by a listener thread. When
+the queue is full records are dropped (and counted) instead of holding up the server. sampling
+lets one in every n records of a category through, for leaving noisy diagnostics on.
+"""
+
+import os
+import queue
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+server_log = logging.getLogger('websocketchat.server')
+connection_log = logging.getLogger('websocketchat.connections')
+request_log = logging.getLogger('websocketchat.requests')
+room_log = logging.getLogger('websocketchat.rooms')
+protocol_log = logging.getLogger('websocketchat.protocol')
+db_log = logging.getLogger('websocketchat.db')
+pubsub_log = logging.getLogger('websocketchat.pubsub')
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sampling):
+        """sampling is {category: n}, one in every n records of the category (or a child of it) passes"""
+        super().__init__()
+        self.sampling = dict(sampling)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        name = record.name
+        n = self.sampling.get(name)
+        while n is None and '.' in name:
+            name = name.rsplit('.', 1)[0]
+            n = self.sampling.get(name)
+        if n is None or n <= 1:
+            return True
+
+        with self.lock:
+            count = self.counts.get(name, 0)
+            self.counts[name] = count + 1
+        return count % n == 0
+
+
+class BackgroundQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler formats the whole record here to make it picklable, a queue.Queue doesn't
+        # need that. Only the message is put together, its arguments can be live objects (clients)
+        # that change before the listener gets to the record, the rest is left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+handler = None
+listener = None
+settings = None
+
+
+def start_logging(level=None, handlers=None, sampling=None, queue_size=10000):
+    """Puts a BackgroundQueueHandler on the root logger and writes its records to handlers (the
+    handlers the root logger had, or a StreamHandler to stderr) from a QueueListener thread"""
+    global handler, listener, settings
+    stop_logging()
+    root = logging.getLogger()
+    if handlers is None:
+        handlers = list(root.handlers) or [logging.StreamHandler()]
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    if level is not None:
+        root.setLevel(level)
+
+    handler = BackgroundQueueHandler(queue.Queue(queue_size))
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+    root.addHandler(handler)
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    settings = {'handlers': handlers, 'sampling': sampling, 'queue_size': queue_size}
+
+
+def stop_logging():
+    """Writes what is left in the queue and puts the handlers back on the root logger"""
+    global handler, listener, settings
+    if listener is None:
+        return
+    listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(handler)
+    for old in listener.handlers:
+        root.addHandler(old)
+    handler = listener = settings = None
+
+
+def restart_after_fork():
+    # The listener thread doesn't exist in a forked child (Supervisor workers), it gets its own
+    global listener
+    if listener is None:
+        return
+    listener = None
+    start_logging(**settings)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_after_fork)
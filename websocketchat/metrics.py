@@ -0,0 +1,231 @@
+#!/bin/env python3
+"""Counters, gauges and latency histograms, exported in the Prometheus text format
+
+    metrics = Metrics()
+    requests = metrics.histogram('chat_request_seconds', 'Time to handle a request', request='login')
+    requests.observe(0.0012)
+    metrics.gauge('chat_connected_clients', 'Open connections', function=lambda: len(clients))
+    MetricsServer(metrics, port=9100).start()  # GET http://127.0.0.1:9100/metrics
+
+Histograms are HDR style: values are kept in microseconds in log-linear buckets (32 per power
+of two, ~3% error) so recording is one increment no matter the range and percentiles can be
+read back. Prometheus gets the counts at power of two boundaries.
+"""
+
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .log import server_log
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def bucket_upper(index):
+    """Largest value counted in the bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    sub_bucket = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return ((sub_bucket + 1) << shift) - 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return ['{}{} {}'.format(name, format_labels(labels), format_value(self.value))]
+
+
+class Gauge:
+    def __init__(self, function=None):
+        """With function the value is read from it when exported"""
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self, name, labels):
+        try:
+            value = self.get()
+        except Exception as e:
+            server_log.error('Metrics: Failed to read gauge %s: %s', name, e)
+            return []
+        return ['{}{} {}'.format(name, format_labels(labels), format_value(value))]
+
+
+class Histogram:
+    def __init__(self, max_seconds=3600):
+        self.counts = [0] * (bucket_index(int(max_seconds * 1e6)) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bucket_index(max(int(seconds * 1e6), 0))
+        with self.lock:
+            if index >= len(self.counts):
+                index = len(self.counts) - 1
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, percentile):
+        """Value in seconds below which percentile % of the observations are"""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return 0
+        rank = max(1, int(count * percentile / 100 + 0.5))
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return bucket_upper(index) / 1e6
+        return bucket_upper(len(counts) - 1) / 1e6
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+
+        lines = []
+        cumulative = 0
+        for index, n in enumerate(counts):
+            cumulative += n
+            upper = bucket_upper(index) + 1
+            # Only the buckets ending at a power of two are exported
+            if upper & (upper - 1) == 0:
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', repr(upper / 1e6)), )), cumulative))
+        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'), )), count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(total)))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        # {name: [type, help, {labels: metric}]}
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = [kind, help, {}]
+            elif family[0] != kind:
+                raise ValueError('{} is a {}, not a {}'.format(name, family[0], kind))
+            metric = family[2].get(labels)
+            if metric is None:
+                metric = family[2][labels] = cls(**kwargs)
+            return metric
+
+    def counter(self, name, help='', **labels):
+        return self.get('counter', Counter, name, help, labels)
+
+    def gauge(self, name, help='', function=None, **labels):
+        return self.get('gauge', Gauge, name, help, labels, function=function)
+
+    def histogram(self, name, help='', **labels):
+        return self.get('histogram', Histogram, name, help, labels)
+
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        with self.lock:
+            families = [(name, family[0], family[1], list(family[2].items()))
+                        for name, family in sorted(self.families.items())]
+
+        lines = []
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in metrics:
+                lines.extend(metric.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves the metrics on http://host:port/metrics, local only by default
+
+    routes are more pages, {path: function(query)} where query is the parsed query string
+    ({name: [value, ...]}) and function returns (content_type, body)"""
+    def __init__(self, metrics, host='127.0.0.1', port=9100, routes=None):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.routes = {'/metrics': lambda query: ('text/plain; version=0.0.4; charset=utf-8', metrics.exposition())}
+        self.routes.update(routes or {})
+        self.server = None
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                route = routes.get(path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                try:
+                    content_type, body = route(parse_qs(query))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server_log.debug('Metrics: ' + format, *args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True).start()
+        server_log.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,145 @@
+#!/bin/env python3
+"""Trace spans and a sampling profiler for finding out where a running server spends its time
+
+    tracer = Tracer()
+    tracer.enabled = True
+    with tracer.span('decrypt'):
+        ...
+    tracer.add('ChatDb.execute', start, end)   # where the times are measured anyway
+    tracer.dump('trace.json')                  # chrome://tracing or https://ui.perfetto.dev
+
+    sampler = Sampler()
+    sampler.start()
+    ...
+    sampler.stop()
+    sampler.dump('profile.collapsed')          # flamegraph.pl profile.collapsed > profile.svg
+
+Spans go to a ring buffer holding the latest size spans, a disabled Tracer costs a check per
+span. The Sampler looks at the stack of every thread interval seconds apart (wall clock, so
+threads waiting on a lock or the socket show up too) and counts the stacks.
+"""
+
+import os
+import sys
+import json
+import threading
+from time import perf_counter, sleep
+from collections import deque
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.start, perf_counter())
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+    def __init__(self, size=65536, enabled=False):
+        self.enabled = enabled
+        # (name, start, duration, thread), appending to a deque is thread safe
+        self.spans = deque(maxlen=size)
+
+    def span(self, name):
+        if not self.enabled:
+            return null_span
+        return Span(self, name)
+
+    def add(self, name, start, end):
+        if self.enabled:
+            self.spans.append((name, start, end - start, threading.get_ident()))
+
+    def clear(self):
+        self.spans.clear()
+
+    def trace(self):
+        """The spans as a trace in the Chrome trace event format"""
+        spans = list(self.spans)
+        events = []
+        for thread in threading.enumerate():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident,
+                           'args': {'name': thread.name}})
+        for name, start, duration, thread in spans:
+            events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread,
+                           'ts': round(start * 1e6, 3), 'dur': round(duration * 1e6, 3)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+
+
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # {'thread;outermost;...;innermost': samples}
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.stacks = {}
+            self.samples = 0
+        self.thread = threading.Thread(target=self.run, name='Sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            sleep(self.interval)
+
+    def collapsed(self):
+        """The stacks in the collapsed format of flamegraph.pl, a 'frame;frame;frame count' line per stack"""
+        stacks = list(self.stacks.items())
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(stacks))
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
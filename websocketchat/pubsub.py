@@ -0,0 +1,316 @@
+#!/bin/env python3
+"""Publish/subscribe between chat nodes (processes or machines)
+
+A node subscribes to the rooms it has loaded and publishes every new room message once,
+the broker hands the message to the other nodes subscribed to the room but never back to
+the node it came from.
+
+    LocalBroker/LocalPubSub    - everything in one process, for tests and development
+    SocketBroker/SocketPubSub  - broker reached over TCP, address=(host, port), or over a
+                                 Unix socket, address='/path/to/socket'
+
+Nodes are used as pubsub.start(on_message), pubsub.subscribe(channel),
+pubsub.unsubscribe(channel), pubsub.publish(channel, message) and pubsub.stop(),
+on_message(channel, message) is called for messages from other nodes.
+"""
+
+import os
+import json
+import uuid
+import queue
+import socket
+import struct
+import threading
+from .log import pubsub_log
+
+
+class PubSub:
+    """Keeps count of the subscriptions of a node so the broker only hears about the first
+    subscribe and the last unsubscribe of a channel"""
+    def __init__(self, node_id=None):
+        self.node_id = node_id or uuid.uuid4().hex
+        self.subscriptions = {}
+        self.subscriptions_lock = threading.Lock()
+        self.on_message = None
+
+    def start(self, on_message):
+        self.on_message = on_message
+
+    def stop(self):
+        pass
+
+    def subscribe(self, channel):
+        with self.subscriptions_lock:
+            count = self.subscriptions.get(channel, 0)
+            self.subscriptions[channel] = count + 1
+            if count == 0:
+                self.broker_subscribe(channel)
+
+    def unsubscribe(self, channel):
+        with self.subscriptions_lock:
+            count = self.subscriptions.get(channel, 0)
+            if count <= 1:
+                self.subscriptions.pop(channel, None)
+                if count == 1:
+                    self.broker_unsubscribe(channel)
+            else:
+                self.subscriptions[channel] = count - 1
+
+    def deliver(self, origin, channel, message):
+        if origin == self.node_id or self.on_message is None:
+            return
+        try:
+            self.on_message(channel, message)
+        except Exception as e:
+            pubsub_log.exception('PubSub: Failed to deliver message on "%s": %s', channel, e)
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def broker_subscribe(self, channel):
+        raise NotImplementedError
+
+    def broker_unsubscribe(self, channel):
+        raise NotImplementedError
+
+
+class LocalBroker:
+    def __init__(self):
+        # {channel: {node_id: node}}
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, node, channel):
+        with self.lock:
+            self.channels.setdefault(channel, {})[node.node_id] = node
+
+    def unsubscribe(self, node, channel):
+        with self.lock:
+            nodes = self.channels.get(channel, {})
+            nodes.pop(node.node_id, None)
+            if not nodes:
+                self.channels.pop(channel, None)
+
+    def publish(self, origin, channel, message):
+        with self.lock:
+            nodes = [node for node_id, node in self.channels.get(channel, {}).items() if node_id != origin]
+        for node in nodes:
+            node.deliver(origin, channel, message)
+
+
+class LocalPubSub(PubSub):
+    def __init__(self, broker, node_id=None):
+        PubSub.__init__(self, node_id)
+        self.broker = broker
+
+    def publish(self, channel, message):
+        self.broker.publish(self.node_id, channel, message)
+
+    def broker_subscribe(self, channel):
+        self.broker.subscribe(self, channel)
+
+    def broker_unsubscribe(self, channel):
+        self.broker.unsubscribe(self, channel)
+
+
+# Every packet is a 4 byte big endian length followed by a JSON encoded [op, origin, channel, message]
+def send_packet(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def recv_packet(sock):
+    length, = struct.unpack('!I', recv_exactly(sock, 4))
+    return recv_exactly(sock, length)
+
+
+def encode_packet(op, origin, channel, message=None):
+    return json.JSONEncoder().encode([op, origin, channel, message]).encode('utf-8')
+
+
+def make_socket(address):
+    if type(address) == str:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class BrokerConnection:
+    """A node connected to the SocketBroker. Packets to the node are queued and written by a thread
+    of its own, so packets forwarded by different publishers can't interleave on the socket and
+    a slow node doesn't hold up the others. Packets are dropped when queue_size are queued."""
+    def __init__(self, sock, queue_size=10000):
+        self.sock = sock
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.write, name='BrokerConnection', daemon=True)
+        self.thread.start()
+
+    def send(self, packet):
+        try:
+            self.queue.put_nowait(packet)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def write(self):
+        while True:
+            packet = self.queue.get()
+            if packet is None:
+                return
+            try:
+                send_packet(self.sock, packet)
+            except OSError as e:
+                pubsub_log.error('Broker: Failed to forward a message: %s', e)
+                return
+
+    def close(self):
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            # The writer fails on the closed socket instead
+            pass
+        self.sock.close()
+
+
+class SocketBroker:
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        # {channel: set(BrokerConnection)}
+        self.channels = {}
+        self.connections = []
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.sock = make_socket(self.address)
+        if type(self.address) == str:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        if type(self.address) != str:
+            # Port 0 picks a free port
+            self.address = self.sock.getsockname()[:2]
+        self.sock.listen(64)
+        self.running = True
+        threading.Thread(target=self.accept, name='SocketBroker', daemon=True).start()
+
+    def accept(self):
+        while self.running:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                break
+            connection = BrokerConnection(sock)
+            with self.lock:
+                self.connections.append(connection)
+            threading.Thread(target=self.serve, args=(connection, ), daemon=True).start()
+
+    def serve(self, connection):
+        try:
+            while True:
+                packet = recv_packet(connection.sock)
+                op, origin, channel, message = json.JSONDecoder().decode(packet.decode('utf-8'))
+                if op == 'sub':
+                    with self.lock:
+                        self.channels.setdefault(channel, set()).add(connection)
+                elif op == 'unsub':
+                    self.remove_subscription(connection, channel)
+                elif op == 'pub':
+                    with self.lock:
+                        subscribers = [c for c in self.channels.get(channel, ()) if c is not connection]
+                    for subscriber in subscribers:
+                        if not subscriber.send(packet):
+                            pubsub_log.warning('Broker: Dropped a message on "%s" for a slow node', channel)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                for channel in list(self.channels):
+                    self.channels[channel].discard(connection)
+                    if not self.channels[channel]:
+                        del self.channels[channel]
+                if connection in self.connections:
+                    self.connections.remove(connection)
+            connection.close()
+
+    def remove_subscription(self, connection, channel):
+        with self.lock:
+            connections = self.channels.get(channel)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self.channels[channel]
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        if type(self.address) == str and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class SocketPubSub(PubSub):
+    def __init__(self, address, node_id=None):
+        PubSub.__init__(self, node_id)
+        self.address = address
+        self.sock = None
+        self.send_lock = threading.Lock()
+
+    def start(self, on_message):
+        PubSub.start(self, on_message)
+        self.sock = make_socket(self.address)
+        self.sock.connect(self.address)
+        threading.Thread(target=self.read, name='SocketPubSub', daemon=True).start()
+
+    def read(self):
+        try:
+            while True:
+                packet = recv_packet(self.sock)
+                try:
+                    op, origin, channel, message = json.JSONDecoder().decode(packet.decode('utf-8'))
+                except ValueError as e:
+                    # The packets are length prefixed so the next one can still be read
+                    pubsub_log.error('PubSub: Received an invalid packet: %s', e)
+                    continue
+                if op == 'pub':
+                    self.deliver(origin, channel, message)
+        except (ConnectionError, OSError):
+            pubsub_log.debug('PubSub: Disconnected from %s', self.address)
+
+    def send(self, op, channel, message=None):
+        data = encode_packet(op, self.node_id, channel, message)
+        with self.send_lock:
+            try:
+                send_packet(self.sock, data)
+            except OSError as e:
+                pubsub_log.error('PubSub: Failed to send %s on "%s": %s', op, channel, e)
+
+    def publish(self, channel, message):
+        self.send('pub', channel, message)
+
+    def broker_subscribe(self, channel):
+        self.send('sub', channel)
+
+    def broker_unsubscribe(self, channel):
+        self.send('unsub', channel)
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
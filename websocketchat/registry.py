@@ -0,0 +1,108 @@
+#!/bin/env python3
+
+import threading
+from concurrent.futures import Future
+
+
+class Registry:
+    """Thread safe dict split over several locks so threads working on different keys
+    don't wait for each other. lock(key) is used for operations that need more than one step.
+    """
+    def __init__(self, stripes=16):
+        self.stripes = [({}, threading.RLock()) for _ in range(stripes)]
+        # {key: Future} of the values get_or_create is making, guarded by the lock of the key
+        self.creating = {}
+
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def lock(self, key):
+        return self.stripe(key)[1]
+
+    def __getitem__(self, key):
+        items, lock = self.stripe(key)
+        with lock:
+            return items[key]
+
+    def __setitem__(self, key, value):
+        items, lock = self.stripe(key)
+        with lock:
+            items[key] = value
+
+    def __delitem__(self, key):
+        items, lock = self.stripe(key)
+        with lock:
+            del items[key]
+
+    def __contains__(self, key):
+        items, lock = self.stripe(key)
+        with lock:
+            return key in items
+
+    def __len__(self):
+        return sum(len(items) for items, lock in self.stripes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        items, lock = self.stripe(key)
+        with lock:
+            return items.get(key, default)
+
+    def pop(self, key, *default):
+        items, lock = self.stripe(key)
+        with lock:
+            return items.pop(key, *default)
+
+    def get_or_create(self, key, create):
+        """Returns the value of key, create(key) is called to make it if it is missing. create runs
+        without the lock (it can be slow, a room is loaded from the database) so it must not be
+        held by the caller either, other threads asking for the key meanwhile wait for the value"""
+        items, lock = self.stripe(key)
+        with lock:
+            value = items.get(key)
+            if value is not None:
+                return value
+            future = self.creating.get(key)
+            if future is None:
+                future = self.creating[key] = Future()
+                creator = True
+            else:
+                creator = False
+
+        if not creator:
+            return future.result()
+        try:
+            value = create(key)
+        except BaseException as e:
+            with lock:
+                del self.creating[key]
+            future.set_exception(e)
+            raise
+        with lock:
+            items[key] = value
+            del self.creating[key]
+        future.set_result(value)
+        return value
+
+    def keys(self):
+        keys = []
+        for items, lock in self.stripes:
+            with lock:
+                keys.extend(items.keys())
+        return keys
+
+    def values(self):
+        values = []
+        for items, lock in self.stripes:
+            with lock:
+                values.extend(items.values())
+        return values
+
+    def items(self):
+        pairs = []
+        for items, lock in self.stripes:
+            with lock:
+                pairs.extend(items.items())
+        return pairs
@@ -0,0 +1,98 @@
+#!/bin/env python3
+"""Runs several Chat worker processes on the same port
+
+The workers use the asyncio engine and bind with SO_REUSEPORT so the kernel spreads new
+connections over them. Room messages are passed between the workers through a SocketBroker
+on a Unix socket running in the supervisor process.
+"""
+
+import os
+import signal
+import tempfile
+import threading
+import multiprocessing
+from .pubsub import SocketBroker, SocketPubSub
+from .log import server_log
+
+
+def run_worker(broker_address, chat_kwargs):
+    # Imported here so nothing of the server exists in the supervisor process
+    from .chat_server import Chat
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    chat = Chat(engine='asyncio', reuse_port=True, pubsub=SocketPubSub(broker_address), **chat_kwargs)
+    chat.start()
+    server_log.info('Worker %s started', os.getpid())
+    stopped.wait()
+    chat.stop()
+
+
+class Supervisor:
+    def __init__(self, workers=None, broker_address=None, **chat_kwargs):
+        """chat_kwargs are passed on to Chat in every worker"""
+        if (chat_kwargs.get('db_kwargs') or {}).get('write_behind'):
+            # MessageWriter hands out message ids itself which only works in one process
+            raise ValueError('write_behind can not be used with several worker processes')
+
+        self.workers = workers or os.cpu_count()
+        self.chat_kwargs = chat_kwargs
+        self.broker = SocketBroker(broker_address or os.path.join(tempfile.mkdtemp(), 'chat_broker.sock'))
+        self.processes = []
+        self.context = multiprocessing.get_context('fork')
+
+    def start_worker(self, i):
+        chat_kwargs = self.chat_kwargs
+        if chat_kwargs.get('metrics_port') is not None:
+            # Every worker serves its own metrics, on metrics_port + the number of the worker
+            chat_kwargs = dict(chat_kwargs, metrics_port=chat_kwargs['metrics_port'] + i)
+        if chat_kwargs.get('capture_kwargs') is not None:
+            # And captures to its own file, path.<number of the worker>
+            capture_kwargs = chat_kwargs['capture_kwargs']
+            chat_kwargs = dict(chat_kwargs, capture_kwargs=dict(capture_kwargs,
+                                                                path='{}.{}'.format(capture_kwargs['path'], i)))
+        process = self.context.Process(target=run_worker, args=(self.broker.address, chat_kwargs), daemon=True)
+        process.start()
+        return process
+
+    def forward_signal(self, signum, frame):
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def start(self):
+        # Toggling the profiler of every worker, see Chat
+        profile_signal = self.chat_kwargs.get('profile_signal', signal.SIGUSR1)
+        if profile_signal is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(profile_signal, self.forward_signal)
+        self.broker.start()
+        for i in range(self.workers):
+            self.processes.append(self.start_worker(i))
+        server_log.info('Started %s workers', self.workers)
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.broker.stop()
+
+    def run(self):
+        """Starts the workers and restarts them if they die, until interrupted"""
+        self.start()
+        try:
+            while True:
+                for i in range(len(self.processes)):
+                    self.processes[i].join(timeout=1 / len(self.processes))
+                    if not self.processes[i].is_alive():
+                        server_log.error('Worker %s died with exit code %s, restarting',
+                                         self.processes[i].pid, self.processes[i].exitcode)
+                        self.processes[i] = self.start_worker(i)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
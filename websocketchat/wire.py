@@ -0,0 +1,226 @@
+#!/bin/env python3
+"""The two wire formats a client can use
+
+    'json'    - text frames, '0' + request_id + JSON, encrypted frames are '1' (client key)
+                or '2' (room key) followed by the hex encoded ciphertext
+    'msgpack' - binary frames, b'0' + request_id + MessagePack, encrypted frames are b'1' or
+                b'2' followed by the raw ciphertext
+
+Room key frames get a new iv each, the ciphertext of a '2' frame starts with its 16 byte iv.
+
+Every client starts with 'json'. The key_iv server message lists the formats the connection
+supports and the client switches with the set_format request.
+
+pack/unpack implement the part of MessagePack used here (nil, bool, int, float, str, bin,
+array and map) so no extra module is needed.
+"""
+
+import json
+import struct
+from .forms import EncodedJson, encode_array
+from .crypto import encrypt, generate_iv
+
+
+def pack(obj):
+    parts = []
+    pack_into(obj, parts)
+    return b''.join(parts)
+
+
+def pack_into(obj, parts):
+    t = type(obj)
+    if t == str:
+        data = obj.encode('utf-8')
+        length = len(data)
+        if length < 32:
+            parts.append(bytes((0xa0 | length, )))
+        elif length < 0x100:
+            parts.append(struct.pack('!BB', 0xd9, length))
+        elif length < 0x10000:
+            parts.append(struct.pack('!BH', 0xda, length))
+        else:
+            parts.append(struct.pack('!BI', 0xdb, length))
+        parts.append(data)
+    elif t == int:
+        if 0 <= obj < 0x80:
+            parts.append(bytes((obj, )))
+        elif -32 <= obj < 0:
+            parts.append(bytes((obj & 0xff, )))
+        elif 0 <= obj < 0x100:
+            parts.append(struct.pack('!BB', 0xcc, obj))
+        elif 0 <= obj < 0x10000:
+            parts.append(struct.pack('!BH', 0xcd, obj))
+        elif 0 <= obj < 0x100000000:
+            parts.append(struct.pack('!BI', 0xce, obj))
+        elif 0 <= obj < 0x10000000000000000:
+            parts.append(struct.pack('!BQ', 0xcf, obj))
+        elif -0x80 <= obj:
+            parts.append(struct.pack('!Bb', 0xd0, obj))
+        elif -0x8000 <= obj:
+            parts.append(struct.pack('!Bh', 0xd1, obj))
+        elif -0x80000000 <= obj:
+            parts.append(struct.pack('!Bi', 0xd2, obj))
+        elif -0x8000000000000000 <= obj:
+            parts.append(struct.pack('!Bq', 0xd3, obj))
+        else:
+            raise ValueError('Integer out of range: {}'.format(obj))
+    elif t == list or t == tuple:
+        length = len(obj)
+        if length < 16:
+            parts.append(bytes((0x90 | length, )))
+        elif length < 0x10000:
+            parts.append(struct.pack('!BH', 0xdc, length))
+        else:
+            parts.append(struct.pack('!BI', 0xdd, length))
+        for item in obj:
+            pack_into(item, parts)
+    elif t == EncodedJson:
+        # Already JSON encoded for the json clients. The cached room history is the same object
+        # for every client entering the room so it is only decoded and packed once
+        packed = obj.packed
+        if packed is None:
+            packed = obj.packed = pack(json.JSONDecoder().decode(obj))
+        parts.append(packed)
+    elif obj is None:
+        parts.append(b'\xc0')
+    elif obj is False:
+        parts.append(b'\xc2')
+    elif obj is True:
+        parts.append(b'\xc3')
+    elif t == float:
+        parts.append(struct.pack('!Bd', 0xcb, obj))
+    elif t == bytes:
+        length = len(obj)
+        if length < 0x100:
+            parts.append(struct.pack('!BB', 0xc4, length))
+        elif length < 0x10000:
+            parts.append(struct.pack('!BH', 0xc5, length))
+        else:
+            parts.append(struct.pack('!BI', 0xc6, length))
+        parts.append(obj)
+    elif t == dict:
+        length = len(obj)
+        if length < 16:
+            parts.append(bytes((0x80 | length, )))
+        elif length < 0x10000:
+            parts.append(struct.pack('!BH', 0xde, length))
+        else:
+            parts.append(struct.pack('!BI', 0xdf, length))
+        for key, value in obj.items():
+            pack_into(key, parts)
+            pack_into(value, parts)
+    else:
+        raise ValueError('Can not pack {}'.format(t))
+
+
+# (struct format, size) of the fixed size values
+fixed = {0xca: ('!f', 4), 0xcb: ('!d', 8),
+         0xcc: ('!B', 1), 0xcd: ('!H', 2), 0xce: ('!I', 4), 0xcf: ('!Q', 8),
+         0xd0: ('!b', 1), 0xd1: ('!h', 2), 0xd2: ('!i', 4), 0xd3: ('!q', 8)}
+# Size of the length of str, bin, array and map
+lengths = {0xd9: 1, 0xda: 2, 0xdb: 4,
+           0xc4: 1, 0xc5: 2, 0xc6: 4,
+           0xdc: 2, 0xdd: 4,
+           0xde: 2, 0xdf: 4}
+length_formats = {1: '!B', 2: '!H', 4: '!I'}
+
+
+def unpack(data):
+    """Raises ValueError if data is not exactly one valid value"""
+    try:
+        obj, i = unpack_from(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, RecursionError, TypeError) as e:
+        raise ValueError('Invalid MessagePack data: {}'.format(e))
+    if i != len(data):
+        raise ValueError('Invalid MessagePack data: {} trailing bytes'.format(len(data) - i))
+    return obj
+
+
+def unpack_from(data, i):
+    b = data[i]
+    i += 1
+    if b < 0x80:
+        return b, i
+    if b >= 0xe0:
+        return b - 0x100, i
+    if 0xa0 <= b <= 0xbf:
+        return read_str(data, i, b & 0x1f)
+    if 0x90 <= b <= 0x9f:
+        return read_array(data, i, b & 0x0f)
+    if 0x80 <= b <= 0x8f:
+        return read_map(data, i, b & 0x0f)
+    if b == 0xc0:
+        return None, i
+    if b == 0xc2:
+        return False, i
+    if b == 0xc3:
+        return True, i
+    if b in fixed:
+        fmt, size = fixed[b]
+        if i + size > len(data):
+            raise IndexError('Truncated value')
+        return struct.unpack_from(fmt, data, i)[0], i + size
+    if b in lengths:
+        size = lengths[b]
+        length = struct.unpack_from(length_formats[size], data, i)[0]
+        i += size
+        if b >= 0xdc:
+            return (read_array if b <= 0xdd else read_map)(data, i, length)
+        if b >= 0xd9:
+            return read_str(data, i, length)
+        if i + length > len(data):
+            raise IndexError('Truncated bin')
+        return bytes(data[i:i + length]), i + length
+    raise ValueError('Unsupported type byte 0x{:02x}'.format(b))
+
+
+def read_str(data, i, length):
+    if i + length > len(data):
+        raise IndexError('Truncated str')
+    return bytes(data[i:i + length]).decode('utf-8'), i + length
+
+
+def read_array(data, i, length):
+    if length > len(data) - i:
+        raise IndexError('Truncated array')
+    array = []
+    for _ in range(length):
+        item, i = unpack_from(data, i)
+        array.append(item)
+    return array, i
+
+
+def read_map(data, i, length):
+    if length * 2 > len(data) - i:
+        raise IndexError('Truncated map')
+    obj = {}
+    for _ in range(length):
+        key, i = unpack_from(data, i)
+        obj[key], i = unpack_from(data, i)
+    return obj, i
+
+
+def encode_body(format, type_id, array):
+    """type_id + the encoded array, what gets encrypted"""
+    if format == 'msgpack':
+        return type_id.encode() + pack(array)
+    return type_id + encode_array(array)
+
+
+def encode_frame(format, body, prefix='0', key=None, iv=None):
+    """A complete frame, str for text frames and bytes for binary frames. prefix is '0' for
+    plaintext, '1' for the client key and '2' for the room key (iv is not used, every frame
+    gets its own)"""
+    if prefix == '2':
+        iv = generate_iv()
+        ciphertext = iv + encrypt(body if format == 'msgpack' else body.encode(), key, iv)
+        if format == 'msgpack':
+            return b'2' + ciphertext
+        return '2' + ciphertext.hex()
+    if format == 'msgpack':
+        if prefix != '0':
+            body = encrypt(body, key, iv)
+        return prefix.encode() + body
+    if prefix == '0':
+        return '0' + body
+    return prefix + encrypt(body.encode(), key, iv).hex()